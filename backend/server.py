@@ -1,22 +1,43 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Header
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
 import os
 from dotenv import load_dotenv
-import requests
 from bs4 import BeautifulSoup
 import re
 import json
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import uuid
 import ast
 import inspect
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+import math
+import ipaddress
+import fcntl
+import hashlib
+import zipfile
+import tarfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import shutil
+import sys
+import time
+import random
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
 import aiofiles
+import httpx
+import numpy as np
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -38,10 +59,62 @@ MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 client = AsyncIOMotorClient(MONGO_URL)
 db = client.ai_database
 
+# Настройки глубокого поиска (загрузка и разбор найденных страниц)
+DEEP_FETCH_CONCURRENCY = int(os.environ.get('DEEP_FETCH_CONCURRENCY', '8'))
+DEEP_FETCH_PER_HOST = int(os.environ.get('DEEP_FETCH_PER_HOST', '2'))
+DEEP_FETCH_MAX_BYTES = int(os.environ.get('DEEP_FETCH_MAX_BYTES', str(512 * 1024)))
+DEEP_FETCH_DEADLINE = float(os.environ.get('DEEP_FETCH_DEADLINE', '15'))
+DEEP_FETCH_QUEUE_SIZE = int(os.environ.get('DEEP_FETCH_QUEUE_SIZE', '16'))
+DEEP_FETCH_MAX_REDIRECTS = int(os.environ.get('DEEP_FETCH_MAX_REDIRECTS', '5'))
+DEEP_FETCH_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+# Количество самых релевантных записей, которые попадают в ответ
+RELEVANCE_TOP_K = int(os.environ.get('RELEVANCE_TOP_K', '3'))
+RELEVANCE_SNIPPET_LIMIT = int(os.environ.get('RELEVANCE_SNIPPET_LIMIT', '10000'))
+# Со скольких документов в снимке поиск по нему уходит из event loop в поток
+RELEVANCE_THREAD_THRESHOLD = int(os.environ.get('RELEVANCE_THREAD_THRESHOLD', '50000'))
+
+# Снимок базы знаний на диске, общий для всех воркеров
+KNOWLEDGE_SNAPSHOT_DIR = os.environ.get('KNOWLEDGE_SNAPSHOT_DIR', '/tmp/knowledge_snapshot')
+KNOWLEDGE_SNAPSHOT_INTERVAL = float(os.environ.get('KNOWLEDGE_SNAPSHOT_INTERVAL', '300'))
+
+# Профилирование запросов (по умолчанию выключено)
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', '0'))
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', '0.005'))
+PROFILER_BUFFER_SIZE = int(os.environ.get('PROFILER_BUFFER_SIZE', '50'))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Загрузка архивов с файлами знаний
+ARCHIVE_MAX_MEMBERS = int(os.environ.get('ARCHIVE_MAX_MEMBERS', '5000'))
+ARCHIVE_MAX_BYTES = int(os.environ.get('ARCHIVE_MAX_BYTES', str(200 * 1024 * 1024)))
+ARCHIVE_WORKERS = int(os.environ.get('ARCHIVE_WORKERS', str(os.cpu_count() or 2)))
+ARCHIVE_INSERT_BATCH = int(os.environ.get('ARCHIVE_INSERT_BATCH', '200'))
+ARCHIVE_JOBS_LIMIT = int(os.environ.get('ARCHIVE_JOBS_LIMIT', '100'))
+ARCHIVE_PROGRESS_INTERVAL = float(os.environ.get('ARCHIVE_PROGRESS_INTERVAL', '1'))
+
+# Предохранитель (circuit breaker) для запросов к DuckDuckGo
+SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT', '10'))
+CIRCUIT_WINDOW = int(os.environ.get('CIRCUIT_WINDOW', '20'))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', '5'))
+CIRCUIT_ERROR_RATE = float(os.environ.get('CIRCUIT_ERROR_RATE', '0.5'))
+CIRCUIT_SLOW_CALL = float(os.environ.get('CIRCUIT_SLOW_CALL', '3'))
+CIRCUIT_SLOW_RATE = float(os.environ.get('CIRCUIT_SLOW_RATE', '0.5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_HALF_OPEN_PROBES = int(os.environ.get('CIRCUIT_HALF_OPEN_PROBES', '1'))
+
+# Хранение истории улучшений и сообщений
+IMPROVEMENTS_KEYFRAME_INTERVAL = int(os.environ.get('IMPROVEMENTS_KEYFRAME_INTERVAL', '20'))
+MESSAGES_RETENTION_DAYS = float(os.environ.get('MESSAGES_RETENTION_DAYS', '0'))
+MESSAGES_RETENTION_MODE = os.environ.get('MESSAGES_RETENTION_MODE', 'rollup')
+HISTORY_COMPACTION_INTERVAL = float(os.environ.get('HISTORY_COMPACTION_INTERVAL', '3600'))
+HISTORY_BATCH_SIZE = int(os.environ.get('HISTORY_BATCH_SIZE', '500'))
+HISTORY_COMPACTION_LOCK = os.environ.get('HISTORY_COMPACTION_LOCK', '/tmp/history-compaction.lock')
+
 # Модели данных
 class ChatMessage(BaseModel):
     message: str
     timestamp: Optional[str] = None
+    deep_fetch: Optional[bool] = False
 
 class ModificationResult(BaseModel):
     success: bool
@@ -51,6 +124,7 @@ class ModificationResult(BaseModel):
 class SearchQuery(BaseModel):
     query: str
     max_results: Optional[int] = 10
+    deep_fetch: Optional[bool] = False
 
 class AIResponse(BaseModel):
     response: str
@@ -58,12 +132,822 @@ class AIResponse(BaseModel):
     improvements: List[str] = []
     knowledge_gained: List[str] = []
 
+class ProfilerSettings(BaseModel):
+    enabled: bool
+    sample_rate: Optional[float] = None
+
+# Профилирование запросов
+class RequestProfile:
+    """Профиль одного запроса: счетчик свернутых стеков вызовов"""
+
+    def __init__(self, method: str, path: str, task: asyncio.Task):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.task = task
+        self.thread_id = threading.get_ident()
+        self.stages: List[str] = []
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.timestamp = datetime.now().isoformat()
+        self.duration = 0.0
+
+    def summary(self) -> Dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "timestamp": self.timestamp,
+            "duration_ms": round(self.duration * 1000, 1),
+            "samples": self.samples
+        }
+
+    def folded(self) -> str:
+        """Свернутые стеки (формат flamegraph.pl / speedscope)"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + "\n"
+
+class RequestProfiler:
+    """Сэмплирующий профайлер запросов
+
+    Отдельный поток с периодом PROFILER_INTERVAL снимает стек каждого
+    профилируемого запроса. Если задача запроса сейчас выполняется, берется
+    стек потока event loop, иначе - цепочка корутин, на которой она ждет
+    (такие стеки помечаются как [ожидание]). Имя текущего этапа, заданного
+    через stage(), добавляется в корень стека.
+    """
+
+    def __init__(self):
+        self.enabled = PROFILER_SAMPLE_RATE > 0
+        self.sample_rate = PROFILER_SAMPLE_RATE
+        self.profiles = deque(maxlen=PROFILER_BUFFER_SIZE)
+        self.active: Dict[asyncio.Task, RequestProfile] = {}
+        self.lock = threading.Lock()
+        self.sampler: Optional[threading.Thread] = None
+
+    def should_profile(self, forced: bool) -> bool:
+        return forced or (self.enabled and random.random() < self.sample_rate)
+
+    def start(self, method: str, path: str) -> RequestProfile:
+        task = asyncio.current_task()
+        profile = RequestProfile(method, path, task)
+        with self.lock:
+            self.active[task] = profile
+            if self.sampler is None or not self.sampler.is_alive():
+                self.sampler = threading.Thread(target=self.sample_loop, name="request-profiler", daemon=True)
+                self.sampler.start()
+        return profile
+
+    def finish(self, profile: RequestProfile):
+        profile.duration = time.perf_counter() - profile.started
+        with self.lock:
+            self.active.pop(profile.task, None)
+        self.profiles.append(profile)
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    @contextmanager
+    def stage(self, name: str):
+        """Метка асинхронного этапа для текущего профилируемого запроса"""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        profile = self.active.get(task) if task else None
+        if profile is None:
+            yield
+            return
+        profile.stages.append(name)
+        try:
+            yield
+        finally:
+            profile.stages.pop()
+
+    @staticmethod
+    def frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+    def running_stack(self, thread_id: int) -> List[str]:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(self.frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def awaiting_stack(self, task: asyncio.Task) -> List[str]:
+        stack = []
+        coro = task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+            if frame is None:
+                break
+            stack.append(self.frame_label(frame))
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+        stack.append('[ожидание]')
+        return stack
+
+    def sample_loop(self):
+        while True:
+            time.sleep(PROFILER_INTERVAL)
+            with self.lock:
+                active = list(self.active.values())
+            if not active:
+                with self.lock:
+                    if not self.active:
+                        self.sampler = None
+                        return
+                continue
+            for profile in active:
+                try:
+                    # current_task(loop) можно вызывать из другого потока: берется задача, которую loop выполняет сейчас
+                    running = asyncio.current_task(profile.task.get_loop()) is profile.task
+                    stack = self.running_stack(profile.thread_id) if running else self.awaiting_stack(profile.task)
+                except Exception:
+                    continue
+                root = [f"{profile.method} {profile.path}"] + [f"[{stage}]" for stage in profile.stages]
+                profile.stacks[";".join(root + stack)] += 1
+                profile.samples += 1
+
+profiler = RequestProfiler()
+
+class ProfilingMiddleware:
+    """ASGI middleware: профилирует выбранные запросы в их собственной задаче
+
+    Запрос профилируется, если профайлер включен и запрос попал в выборку,
+    либо если заголовок X-Profile совпадает с ADMIN_TOKEN (без заданного
+    токена заголовок игнорируется). Идентификатор профиля возвращается в заголовке X-Profile-Id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith('/api/admin/'):
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get('headers') or [])
+        requested = headers.get(b'x-profile', b'').decode('latin-1')
+        forced = bool(ADMIN_TOKEN) and requested == ADMIN_TOKEN
+        if not profiler.should_profile(forced):
+            await self.app(scope, receive, send)
+            return
+
+        profile = profiler.start(scope.get('method', ''), scope['path'])
+
+        async def send_with_profile_id(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=list(message.get('headers', [])) + [(b'x-profile-id', profile.id.encode())])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profiler.finish(profile)
+
+app.add_middleware(ProfilingMiddleware)
+
+def check_admin_token(token: Optional[str]):
+    """Админские эндпоинты доступны только при заданном ADMIN_TOKEN"""
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Доступ запрещен")
+
+# Предохранитель для внешних сервисов
+class CircuitBreaker:
+    """Предохранитель с порогами по доле ошибок и доле медленных вызовов
+
+    closed: вызовы идут в сервис, результаты копятся в скользящем окне.
+    open: вызовы сразу уходят в резервный путь, пока не истечет
+    CIRCUIT_OPEN_SECONDS. half_open: пропускается CIRCUIT_HALF_OPEN_PROBES
+    пробных вызовов, успех закрывает предохранитель, ошибка снова открывает.
+
+    allow() выдает номер поколения, который увеличивается при каждой смене
+    состояния. Результат вызова, разрешенного в прошлом поколении, попадает
+    в метрики, но не меняет состояние: долгий запрос, начатый до открытия,
+    не должен закрыть или заново открыть предохранитель.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.window = deque(maxlen=CIRCUIT_WINDOW)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.generation = 0
+        self.metrics = Counter()
+        self.transitions = Counter()
+        self.last_transition: Optional[str] = None
+
+    def transition(self, state: str):
+        self.transitions[f"{self.state}->{state}"] += 1
+        self.last_transition = datetime.now().isoformat()
+        print(f"Предохранитель {self.name}: {self.state} -> {state}")
+        self.state = state
+        self.generation += 1
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        elif state == self.CLOSED:
+            self.window.clear()
+        self.probes = 0
+
+    def allow(self) -> Optional[int]:
+        """Поколение, в котором разрешен вызов, или None, если обращаться к сервису нельзя"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= CIRCUIT_OPEN_SECONDS:
+            self.transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN and self.probes < CIRCUIT_HALF_OPEN_PROBES:
+            self.probes += 1
+            self.metrics['probes'] += 1
+            return self.generation
+        if self.state == self.CLOSED:
+            return self.generation
+        self.metrics['short_circuited'] += 1
+        return None
+
+    def record(self, generation: int, success: bool, latency: float):
+        """Учет результата вызова, разрешенного через allow() в поколении generation"""
+        slow = latency >= CIRCUIT_SLOW_CALL
+        self.metrics['calls'] += 1
+        self.metrics['failures'] += 0 if success else 1
+        self.metrics['slow_calls'] += 1 if slow else 0
+        if generation != self.generation:
+            self.metrics['stale_results'] += 1
+            return
+
+        if self.state == self.HALF_OPEN:
+            self.transition(self.CLOSED if success and not slow else self.OPEN)
+            return
+        if self.state != self.CLOSED:
+            return
+
+        self.window.append((success, slow))
+        if len(self.window) < CIRCUIT_MIN_CALLS:
+            return
+        error_rate = sum(1 for ok, _ in self.window if not ok) / len(self.window)
+        slow_rate = sum(1 for _, is_slow in self.window if is_slow) / len(self.window)
+        if error_rate >= CIRCUIT_ERROR_RATE or slow_rate >= CIRCUIT_SLOW_RATE:
+            self.transition(self.OPEN)
+
+    def status(self) -> Dict:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "window_calls": len(self.window),
+            "window_failures": sum(1 for ok, _ in self.window if not ok),
+            "window_slow_calls": sum(1 for _, slow in self.window if slow),
+            "metrics": dict(self.metrics),
+            "transitions": dict(self.transitions),
+            "last_transition": self.last_transition
+        }
+
+# Ранжирование знаний по релевантности (TF-IDF)
+def inverse_document_frequency(documents: int, doc_freq):
+    """IDF со сглаживанием, одна формула для всех слоев и для запроса"""
+    return np.log((1.0 + documents) / (1.0 + doc_freq)) + 1.0
+
+def query_weights(token_counts: Dict[str, int], documents: int, doc_frequency) -> Dict[str, float]:
+    """Нормированные веса терминов запроса по общей статистике всех слоев
+
+    Норма считается по всем терминам запроса, включая те, которых нет
+    в конкретном слое. Документ, совпавший только с частью запроса,
+    не получает полный вес запроса из-за того, что его слой не знает
+    остальных терминов.
+    """
+    weights = {
+        token: (1.0 + math.log(count)) * float(inverse_document_frequency(documents, doc_frequency(token)))
+        for token, count in token_counts.items()
+    }
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return {token: weight / norm for token, weight in weights.items()}
+
+def query_vector(weighted_terms: Dict[int, float], size: int) -> np.ndarray:
+    """Вектор запроса в словаре слоя по уже нормированным весам терминов"""
+    vector = np.zeros(size, dtype=np.float32)
+    for term_id, weight in weighted_terms.items():
+        vector[term_id] = weight
+    return vector
+
+def top_rows(scores: np.ndarray, top_k: int) -> List[int]:
+    """Номера строк с наибольшей ненулевой оценкой, по убыванию"""
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return []
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    best = best[np.argsort(-scores[best])]
+    return [int(row) for row in best if scores[row] > 0]
+
+class KnowledgeSnapshot:
+    """Снимок индекса знаний на диске, открывается через mmap только для чтения
+
+    Все данные лежат в плоских массивах .npy: строки переменной длины
+    (термины, ключи, документы) хранятся одним байтовым блоком, а массив
+    смещений задает границы каждой записи. Термины и ключи отсортированы,
+    поэтому поиск по ним идет двоичным поиском прямо по отображенной памяти.
+    Элементы матрицы сгруппированы по терминам (term_offsets), так что запрос
+    читает только списки документов своих терминов, а не всю матрицу.
+    Страницы файлов разделяются всеми воркерами через кэш ОС.
+    """
+
+    VERSION = 3
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != self.VERSION:
+            raise ValueError(f"Неподдерживаемая версия снимка: {self.meta.get('version')}")
+        self.rows = self.load('rows')
+        self.weights = self.load('weights')
+        self.term_offsets = self.load('term_offsets')
+        self.doc_freq = self.load('doc_freq')
+        self.vocab_offsets = self.load('vocab_offsets')
+        self.vocab = self.load('vocab')
+        self.key_offsets = self.load('key_offsets')
+        self.keys = self.load('keys')
+        self.key_rows = self.load('key_rows')
+        self.payload_offsets = self.load('payload_offsets')
+        self.payloads = self.load('payloads')
+        self.documents = len(self.payload_offsets) - 1
+
+    def load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode='r')
+
+    @staticmethod
+    def pack(values: List[bytes]):
+        """Упаковка строк в байтовый блок и массив смещений"""
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(value) for value in values])
+        return offsets, np.frombuffer(b''.join(values), dtype=np.uint8)
+
+    @staticmethod
+    def record(offsets: np.ndarray, blob: np.ndarray, index: int) -> bytes:
+        return blob[offsets[index]:offsets[index + 1]].tobytes()
+
+    def find(self, offsets: np.ndarray, blob: np.ndarray, value: str) -> int:
+        """Двоичный поиск строки в отсортированном блоке, -1 если не найдена"""
+        target = value.encode('utf-8')
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            current = self.record(offsets, blob, middle)
+            if current < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(offsets) - 1 and self.record(offsets, blob, low) == target:
+            return low
+        return -1
+
+    def key_row(self, key: str) -> int:
+        """Строка документа с данным ключом, -1 если его нет в снимке"""
+        index = self.find(self.key_offsets, self.keys, key)
+        return int(self.key_rows[index]) if index >= 0 else -1
+
+    def payload(self, row: int) -> Dict:
+        return json.loads(self.record(self.payload_offsets, self.payloads, row).decode('utf-8'))
+
+    def doc_frequency(self, token: str) -> int:
+        term_id = self.find(self.vocab_offsets, self.vocab, token)
+        return int(self.doc_freq[term_id]) if term_id >= 0 else 0
+
+    def search(self, query: Dict[str, float], top_k: int, excluded=()) -> List[Dict]:
+        """Оценка запроса по документам снимка, кроме замененных (excluded)
+
+        Оцениваются только документы из списков терминов запроса, поэтому
+        время зависит от длины этих списков, а не от размера снимка.
+        """
+        rows, weights = [], []
+        for token, weight in query.items():
+            term_id = self.find(self.vocab_offsets, self.vocab, token)
+            if term_id >= 0:
+                start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+                rows.append(self.rows[start:end])
+                weights.append(self.weights[start:end] * np.float32(weight))
+        if not rows:
+            return []
+        rows, weights = np.concatenate(rows), np.concatenate(weights)
+        if len(rows) * 8 >= self.documents:
+            # Частые термины: плотный подсчет по всем строкам дешевле сортировки
+            candidates = np.arange(self.documents)
+            scores = np.bincount(rows, weights=weights, minlength=self.documents)
+        else:
+            candidates, positions = np.unique(rows, return_inverse=True)
+            scores = np.bincount(positions, weights=weights, minlength=len(candidates))
+        if excluded:
+            scores[np.isin(candidates, np.fromiter(excluded, dtype=np.int64, count=len(excluded)))] = 0
+        return [dict(self.payload(int(candidates[index])), score=float(scores[index])) for index in top_rows(scores, top_k)]
+
+    @classmethod
+    def write(cls, path: str, engine: 'RelevanceEngine', meta: Dict):
+        """Запись индекса в новый каталог снимка"""
+        os.makedirs(path)
+        weights = engine.normalized_weights()
+
+        # Термины сортируем по байтам, чтобы искать их двоичным поиском
+        sorted_terms = sorted(engine.vocabulary, key=lambda term: term.encode('utf-8'))
+        remap = np.zeros(len(sorted_terms), dtype=np.int32)
+        for new_id, term in enumerate(sorted_terms):
+            remap[engine.vocabulary[term]] = new_id
+        sorted_doc_freq = np.zeros(len(sorted_terms), dtype=np.int64)
+        sorted_doc_freq[remap] = engine.doc_freq[:len(sorted_terms)]
+
+        # Замененные документы в снимок не попадают, строки нумеруются заново
+        alive = np.array([payload is not None for payload in engine.payloads], dtype=bool)
+        row_remap = np.cumsum(alive, dtype=np.int32) - 1
+        rows = engine.rows[:engine.nnz]
+        entries = np.flatnonzero(alive[rows])
+
+        # Элементы группируются по терминам: списки документов для каждого термина
+        terms = remap[engine.terms[:engine.nnz][entries]]
+        order = np.argsort(terms, kind='stable')
+        entries = entries[order]
+        term_offsets = np.zeros(len(sorted_terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(sorted_terms)))
+
+        vocab_offsets, vocab = cls.pack([term.encode('utf-8') for term in sorted_terms])
+        sorted_keys = sorted(engine.keys.items(), key=lambda item: item[0].encode('utf-8'))
+        key_offsets, keys = cls.pack([key.encode('utf-8') for key, _ in sorted_keys])
+        key_rows = row_remap[np.array([row for _, row in sorted_keys], dtype=np.int64)]
+        payload_offsets, payloads = cls.pack([
+            json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+            for payload in engine.payloads if payload is not None
+        ])
+        arrays = {
+            'rows': row_remap[rows[entries]],
+            'weights': weights[entries],
+            'term_offsets': term_offsets,
+            'doc_freq': sorted_doc_freq,
+            'vocab_offsets': vocab_offsets,
+            'vocab': vocab,
+            'key_offsets': key_offsets,
+            'keys': keys,
+            'key_rows': key_rows,
+            'payload_offsets': payload_offsets,
+            'payloads': payloads
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+        # meta.json пишется последним: без него каталог считается недописанным
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, version=cls.VERSION, documents=engine.documents), f)
+
+TOKEN_RE = re.compile(r'[a-zA-Zа-яА-ЯёЁ0-9_]{2,}')
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+def count_tokens(text: str) -> Dict[str, int]:
+    counts: Dict[str, int] = {}
+    for token in tokenize(text):
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+def knowledge_document(record: Dict):
+    """Ключ, текст и данные для выдачи по записи из db.knowledge"""
+    filename = record.get('filename', '')
+    knowledge = record.get('knowledge', [])
+    return f"knowledge:{filename}", f"{filename} {' '.join(knowledge)}", {
+        'title': f"Знания из {filename}",
+        'snippet': '; '.join(knowledge[:5]),
+        'url': filename if record.get('source') == 'web' else f"knowledge://{filename}",
+        'source': 'knowledge'
+    }
+
+class RelevanceEngine:
+    """Разреженная TF-IDF матрица одного слоя индекса
+
+    Матрица хранится в формате COO в массивах NumPy (строка, термин, вес),
+    новые документы дописываются в конец без перестроения индекса.
+    Повторный ключ заменяет документ: старая строка обнуляется и больше
+    не участвует в выдаче.
+
+    background - корпус, на фоне которого считается IDF слоя (объект
+    с documents и doc_frequency(token)): небольшой слой с собственным IDF
+    завышал бы вес частых слов. Частота термина в фоне запоминается, когда
+    термин впервые появляется в слое.
+    """
+
+    def __init__(self, background=None):
+        self.background = background
+        self.vocabulary: Dict[str, int] = {}
+        self.keys: Dict[str, int] = {}
+        self.payloads: List[Optional[Dict]] = []
+        self.spans: List[tuple] = []
+        self.documents = 0
+        self.doc_freq = np.zeros(1024, dtype=np.int64)
+        self.base_freq = np.zeros(1024, dtype=np.int64)
+        self.rows = np.zeros(4096, dtype=np.int32)
+        self.terms = np.zeros(4096, dtype=np.int32)
+        self.tf = np.zeros(4096, dtype=np.float32)
+        self.nnz = 0
+        self._weights = None
+
+    def _reserve(self, extra: int):
+        """Увеличение массивов матрицы с запасом (удвоение емкости)"""
+        needed = self.nnz + extra
+        if needed <= len(self.rows):
+            return
+        capacity = max(needed, len(self.rows) * 2)
+        for name in ('rows', 'terms', 'tf'):
+            old = getattr(self, name)
+            grown = np.zeros(capacity, dtype=old.dtype)
+            grown[:self.nnz] = old[:self.nnz]
+            setattr(self, name, grown)
+
+    def _term_id(self, term: str) -> int:
+        term_id = self.vocabulary.get(term)
+        if term_id is None:
+            term_id = len(self.vocabulary)
+            self.vocabulary[term] = term_id
+            if term_id >= len(self.doc_freq):
+                for name in ('doc_freq', 'base_freq'):
+                    old = getattr(self, name)
+                    grown = np.zeros(len(old) * 2, dtype=np.int64)
+                    grown[:len(old)] = old
+                    setattr(self, name, grown)
+            if self.background is not None:
+                self.base_freq[term_id] = self.background.doc_frequency(term)
+        return term_id
+
+    def add_document(self, key: str, text: str, payload: Dict):
+        """Добавление документа в индекс, документ с тем же ключом заменяется"""
+        self.remove_document(key)
+        counts: Dict[int, int] = {}
+        for token in tokenize(text):
+            term_id = self._term_id(token)
+            counts[term_id] = counts.get(term_id, 0) + 1
+
+        row = len(self.payloads)
+        self.keys[key] = row
+        self.payloads.append(payload)
+        self.documents += 1
+        self._reserve(len(counts))
+        end = self.nnz + len(counts)
+        if counts:
+            term_ids = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+            term_counts = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+            self.rows[self.nnz:end] = row
+            self.terms[self.nnz:end] = term_ids
+            self.tf[self.nnz:end] = 1.0 + np.log(term_counts)
+            self.doc_freq[term_ids] += 1
+        self.spans.append((self.nnz, end))
+        self.nnz = end
+        self._weights = None
+
+    def remove_document(self, key: str) -> bool:
+        row = self.keys.pop(key, None)
+        if row is None:
+            return False
+        start, end = self.spans[row]
+        self.doc_freq[self.terms[start:end]] -= 1
+        self.tf[start:end] = 0
+        self.payloads[row] = None
+        self.documents -= 1
+        self._weights = None
+        return True
+
+    def doc_frequency(self, token: str) -> int:
+        term_id = self.vocabulary.get(token)
+        return int(self.doc_freq[term_id]) if term_id is not None else 0
+
+    def normalized_weights(self) -> np.ndarray:
+        """TF-IDF веса с L2-нормировкой строк, пересчитываются после изменений"""
+        if self._weights is None:
+            rows = self.rows[:self.nnz]
+            terms = self.terms[:self.nnz]
+            size = len(self.vocabulary)
+            documents = self.documents + (self.background.documents if self.background is not None else 0)
+            idf = inverse_document_frequency(documents, self.doc_freq[:size] + self.base_freq[:size]).astype(np.float32)
+            weights = self.tf[:self.nnz] * idf[terms]
+            norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(self.payloads))).astype(np.float32)
+            norms[norms == 0] = 1.0
+            self._weights = weights / norms[rows]
+        return self._weights
+
+    def search(self, query: Dict[str, float], top_k: int) -> List[Dict]:
+        """Оценка запроса по всем документам слоя одной векторной операцией"""
+        weighted_terms = {
+            self.vocabulary[token]: weight for token, weight in query.items() if token in self.vocabulary
+        }
+        if not weighted_terms or not self.documents:
+            return []
+        weights = self.normalized_weights()
+        vector = query_vector(weighted_terms, len(self.vocabulary))
+        scores = np.bincount(self.rows[:self.nnz], weights=weights * vector[self.terms[:self.nnz]], minlength=len(self.payloads))
+        return [dict(self.payloads[row], score=float(scores[row])) for row in top_rows(scores, top_k)]
+
+class RelevanceIndex:
+    """Индекс релевантности из нескольких слоев
+
+    Знания (снимок на диске и записи после него) меняются только при
+    загрузках, поэтому их веса кэшируются между запросами. Сниппеты поиска,
+    которые добавляются на каждый запрос к чату, лежат в отдельных небольших
+    слоях: текущем и предыдущем поколении. Когда текущее поколение
+    заполняется, предыдущее выбрасывается целиком, так что кэш сниппетов
+    не больше RELEVANCE_SNIPPET_LIMIT документов.
+
+    Вектор запроса один для всех слоев: IDF его терминов и норма считаются
+    по сумме статистики всех слоев. Документы слоя знаний взвешиваются
+    на фоне снимка, сниппеты - на фоне снимка и слоя знаний. Частоты фона
+    запоминаются при первом появлении термина в слое, так что после
+    загрузок IDF слоев расходится с общим лишь немного.
+    """
+
+    def __init__(self, snapshot: Optional[KnowledgeSnapshot] = None):
+        self.snapshot = snapshot
+        self.shadowed: set = set()
+        self.pending: Optional[List[Dict]] = None
+        self.knowledge = RelevanceEngine(snapshot)
+        self.snippets = RelevanceEngine(self)
+        self.previous_snippets = RelevanceEngine(self)
+
+    @property
+    def documents(self) -> int:
+        """Документы корпуса знаний (снимок и слой знаний) - фон для сниппетов"""
+        return (self.snapshot.documents if self.snapshot else 0) + self.knowledge.documents
+
+    def doc_frequency(self, token: str) -> int:
+        snapshot_frequency = self.snapshot.doc_frequency(token) if self.snapshot else 0
+        return snapshot_frequency + self.knowledge.doc_frequency(token)
+
+    def add_knowledge(self, record: Dict) -> bool:
+        """Индексация записи из db.knowledge"""
+        key, text, payload = knowledge_document(record)
+        if self.pending is not None:
+            # Идет перезагрузка слоя знаний: запись будет повторена в новом слое
+            self.pending.append(record)
+        if self.snapshot:
+            row = self.snapshot.key_row(key)
+            if row >= 0:
+                self.shadowed.add(row)
+        self.knowledge.add_document(key, text, payload)
+        return True
+
+    def start_reload(self):
+        self.pending = []
+
+    def swap_knowledge(self, snapshot: Optional[KnowledgeSnapshot], knowledge: RelevanceEngine):
+        """Замена снимка и слоя знаний, кэш сниппетов сохраняется
+
+        Записи, добавленные после start_reload, повторяются в новом слое:
+        запрос к базе при перезагрузке мог их уже не увидеть.
+        """
+        pending = self.pending or []
+        self.pending = None
+        self.snapshot = snapshot
+        self.shadowed = set()
+        self.knowledge = knowledge
+        for record in pending:
+            self.add_knowledge(record)
+
+    def add_search_result(self, result: Dict) -> bool:
+        """Индексация результата поиска (кэш сниппетов)"""
+        key = f"search:{result.get('url') or result.get('title', '')}"
+        if key in self.snippets.keys or key in self.previous_snippets.keys:
+            return False
+        if self.snippets.documents >= max(1, RELEVANCE_SNIPPET_LIMIT // 2):
+            self.previous_snippets = self.snippets
+            self.snippets = RelevanceEngine(self)
+        self.snippets.add_document(key, f"{result.get('title', '')} {result.get('snippet', '')}", dict(result, source='search'))
+        return True
+
+    def query_weights(self, query: str) -> Dict[str, float]:
+        token_counts = count_tokens(query)
+        if not token_counts:
+            return {}
+        layers = (self.snippets, self.previous_snippets)
+        documents = self.documents + sum(layer.documents for layer in layers)
+        return query_weights(
+            token_counts, documents,
+            lambda token: self.doc_frequency(token) + sum(layer.doc_frequency(token) for layer in layers)
+        )
+
+    def merge(self, results: List[Dict], query: Dict[str, float], top_k: int) -> List[Dict]:
+        """Добавление оценок слоев в памяти к результатам снимка"""
+        for layer in (self.knowledge, self.snippets, self.previous_snippets):
+            results.extend(layer.search(query, top_k))
+        results.sort(key=lambda result: result['score'], reverse=True)
+        return results[:top_k]
+
+    def search(self, query: str, top_k: int = RELEVANCE_TOP_K) -> List[Dict]:
+        weights = self.query_weights(query)
+        if not weights:
+            return []
+        results = self.snapshot.search(weights, top_k, self.shadowed) if self.snapshot else []
+        return self.merge(results, weights, top_k)
+
+    async def search_async(self, query: str, top_k: int = RELEVANCE_TOP_K) -> List[Dict]:
+        """Поиск из event loop: большой снимок (он неизменяем) оценивается в потоке"""
+        weights = self.query_weights(query)
+        if not weights:
+            return []
+        snapshot = self.snapshot
+        results = []
+        if snapshot and snapshot.documents >= RELEVANCE_THREAD_THRESHOLD:
+            results = await asyncio.to_thread(snapshot.search, weights, top_k, frozenset(self.shadowed))
+        elif snapshot:
+            results = snapshot.search(weights, top_k, self.shadowed)
+        return self.merge(results, weights, top_k)
+
+# Извлечение знаний из файлов и архивов
+KNOWLEDGE_EXTENSIONS = ('.py', '.js', '.jsx', '.txt', '.md')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar.gz', '.tgz')
+
+def extract_knowledge(content: str, file_path: str) -> List[str]:
+    """Извлечение знаний из текста, тип определяется по расширению имени"""
+    knowledge = []
+    name = file_path.lower()
+
+    try:
+        # Простое извлечение ключевых слов и паттернов
+        if name.endswith('.py'):
+            # Ищем импорты
+            imports = re.findall(r'(?:from|import)\s+(\w+)', content)
+            knowledge.extend([f"Python модуль: {imp}" for imp in imports[:10]])
+
+            # Ищем функции
+            functions = re.findall(r'def\s+(\w+)', content)
+            knowledge.extend([f"Python функция: {func}" for func in functions[:5]])
+
+        elif name.endswith(('.js', '.jsx')):
+            # Ищем импорты ES6
+            imports = re.findall(r'import.*from\s+[\'"]([^\'"]+)[\'"]', content)
+            knowledge.extend([f"JavaScript модуль: {imp}" for imp in imports[:10]])
+
+        elif name.endswith(('.txt', '.md')):
+            # Извлекаем ключевые слова из текста
+            words = re.findall(r'\b[a-zA-Zа-яА-Я]{5,}\b', content)
+            # Берем уникальные слова
+            unique_words = list(set(words))[:20]
+            knowledge.extend([f"Ключевое слово: {word}" for word in unique_words])
+
+        # Общие паттерны
+        urls = re.findall(r'https?://[^\s]+', content)
+        knowledge.extend([f"URL: {url}" for url in urls[:5]])
+
+    except Exception as e:
+        knowledge.append(f"Ошибка обработки файла: {str(e)}")
+
+    return knowledge
+
+def iter_archive_members(archive_path: str, archive_name: str):
+    """Потоковый обход файлов архива без распаковки на диск"""
+    if archive_name.lower().endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    with archive.open(info) as stream:
+                        yield info.filename, stream
+    else:
+        # Режим r|gz читает архив последовательно, без произвольного доступа
+        with tarfile.open(archive_path, mode='r|gz') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+
+def iter_knowledge_members(archive_path: str, archive_name: str, progress: Dict):
+    """Файлы знаний из архива с проверкой ARCHIVE_MAX_MEMBERS и ARCHIVE_MAX_BYTES
+
+    progress получает счетчики members_skipped и bytes_read. При нарушении
+    лимита поднимается ValueError.
+    """
+    members = 0
+    for member_name, stream in iter_archive_members(archive_path, archive_name):
+        members += 1
+        if members > ARCHIVE_MAX_MEMBERS:
+            raise ValueError(f"Слишком много файлов в архиве (больше {ARCHIVE_MAX_MEMBERS})")
+        if not member_name.lower().endswith(KNOWLEDGE_EXTENSIONS):
+            progress["members_skipped"] += 1
+            continue
+        # Размер из заголовка архива не проверяем: читаем не больше остатка лимита
+        data = stream.read(ARCHIVE_MAX_BYTES - progress["bytes_read"] + 1)
+        progress["bytes_read"] += len(data)
+        if progress["bytes_read"] > ARCHIVE_MAX_BYTES:
+            raise ValueError(f"Превышен лимит распакованного размера ({ARCHIVE_MAX_BYTES} байт)")
+        yield member_name, data
+
+def check_archive_limits(archive_path: str, archive_name: str):
+    """Проход по архиву до записи знаний: архив сверх лимитов отклоняется целиком"""
+    for _ in iter_knowledge_members(archive_path, archive_name, {"members_skipped": 0, "bytes_read": 0}):
+        pass
+
 # Основной класс самомодифицирующегося ИИ
 class SelfModifyingAI:
     def __init__(self):
         self.knowledge_base = {}
         self.code_patterns = {}
         self.improvement_history = []
+        self.relevance = RelevanceIndex()
+        self.search_breaker = CircuitBreaker('duckduckgo')
         self.russian_responses = {
             "greeting": "Привет! Я самомодифицирующийся ИИ. Я постоянно изучаю новые технологии и улучшаю свой код.",
             "searching": "Ищу новую информацию в интернете...",
@@ -73,10 +957,20 @@ class SelfModifyingAI:
             "error": "Произошла ошибка при выполнении операции."
         }
 
-    async def search_web(self, query: str, max_results: int = 10) -> List[Dict]:
+    async def search_web(self, query: str, max_results: int = 10, deep_fetch: bool = False) -> List[Dict]:
         """Поиск информации в интернете без использования платных API"""
         results = []
         
+        # Пока DuckDuckGo недоступен, сразу отвечаем из резервной базы знаний
+        generation = self.search_breaker.allow()
+        if generation is None:
+            results = await self.get_fallback_knowledge(query)
+            if deep_fetch and results:
+                await self.deep_fetch_results(results)
+            return results
+        
+        started = time.monotonic()
+        success = False
         try:
             # Используем DuckDuckGo через прямые запросы (бесплатно)
             search_url = f"https://html.duckduckgo.com/html/"
@@ -86,33 +980,239 @@ class SelfModifyingAI:
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
             
-            response = requests.get(search_url, params=params, headers=headers, timeout=10)
-            if response.status_code == 200:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                search_results = soup.find_all('div', class_='result__body')
+            async with httpx.AsyncClient(headers=headers, timeout=SEARCH_TIMEOUT) as http:
+                response = await asyncio.wait_for(http.get(search_url, params=params), timeout=SEARCH_TIMEOUT)
+            if response.status_code != 200:
+                raise RuntimeError(f"DuckDuckGo ответил со статусом {response.status_code}")
+            
+            soup = BeautifulSoup(response.content, 'html.parser')
+            search_results = soup.find_all('div', class_='result__body')
+            
+            for result in search_results[:max_results]:
+                title_elem = result.find('h2', class_='result__title')
+                snippet_elem = result.find('div', class_='result__snippet')
                 
-                for result in search_results[:max_results]:
-                    title_elem = result.find('h2', class_='result__title')
-                    snippet_elem = result.find('div', class_='result__snippet')
+                if title_elem and snippet_elem:
+                    title = title_elem.get_text().strip()
+                    snippet = snippet_elem.get_text().strip()
+                    link_elem = title_elem.find('a')
+                    url = link_elem.get('href', '') if link_elem else ''
                     
-                    if title_elem and snippet_elem:
-                        title = title_elem.get_text().strip()
-                        snippet = snippet_elem.get_text().strip()
-                        link_elem = title_elem.find('a')
-                        url = link_elem.get('href', '') if link_elem else ''
-                        
-                        results.append({
-                            'title': title,
-                            'snippet': snippet,
-                            'url': url,
-                            'timestamp': datetime.now().isoformat()
-                        })
+                    results.append({
+                        'title': title,
+                        'snippet': snippet,
+                        'url': url,
+                        'timestamp': datetime.now().isoformat()
+                    })
+            
+            success = True
         
         except Exception as e:
             print(f"Ошибка поиска: {e}")
             # Fallback: используем заранее подготовленную базу знаний
             results = await self.get_fallback_knowledge(query)
         
+        finally:
+            # Учитываем и отмененные вызовы, иначе пробный запрос в half_open не завершится
+            self.search_breaker.record(generation, success, time.monotonic() - started)
+        
+        if deep_fetch and results:
+            await self.deep_fetch_results(results)
+        
+        return results
+
+    def resolve_result_url(self, url: str) -> str:
+        """Получение настоящего адреса из ссылки-редиректа DuckDuckGo"""
+        if url.startswith('//'):
+            url = 'https:' + url
+        parsed = urlparse(url)
+        if parsed.netloc.endswith('duckduckgo.com') and parsed.path.startswith('/l/'):
+            target = parse_qs(parsed.query).get('uddg')
+            if target:
+                return target[0]
+        return url
+
+    def html_to_text(self, html: bytes) -> str:
+        """Извлечение читаемого текста из HTML страницы"""
+        soup = BeautifulSoup(html, 'html.parser')
+        for tag in soup(['script', 'style', 'noscript', 'header', 'footer', 'nav']):
+            tag.decompose()
+        return re.sub(r'\s+', ' ', soup.get_text(' ')).strip()
+
+    async def public_address(self, url: str) -> Optional[str]:
+        """IP для подключения к адресу http(s), если все IP хоста публичные
+
+        None - схема не http(s) или хост разрешается хотя бы в один
+        локальный или внутренний адрес.
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            return None
+        try:
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+            addresses = await asyncio.get_running_loop().getaddrinfo(parsed.hostname, port)
+        except (OSError, ValueError):
+            return None
+        ips = [address[4][0].split('%')[0] for address in addresses]
+        if not ips or not all(ipaddress.ip_address(ip).is_global for ip in ips):
+            return None
+        return ips[0]
+
+    async def is_public_url(self, url: str) -> bool:
+        """Адрес http(s), все IP которого публичные (не локальные и не внутренние)"""
+        return await self.public_address(url) is not None
+
+    async def fetch_page(self, http: httpx.AsyncClient, url: str, host_limits: Optional[Dict[str, asyncio.Semaphore]] = None) -> Optional[bytes]:
+        """Загрузка HTML страницы с ограничением на количество байт
+
+        Редиректы обрабатываются вручную, чтобы проверять каждый адрес:
+        ссылка из результатов поиска не должна увести сервер во внутреннюю сеть.
+        Подключение идет к тому IP, который прошел проверку (Host и SNI
+        остаются от имени хоста), поэтому повторный ответ DNS с другим
+        адресом не подменит цель. Лимит DEEP_FETCH_PER_HOST берется
+        на каждом шаге отдельно для хоста этого шага.
+        """
+        host_limits = host_limits if host_limits is not None else {}
+        for _ in range(DEEP_FETCH_MAX_REDIRECTS + 1):
+            address = await self.public_address(url)
+            if address is None:
+                return None
+            target = httpx.URL(url)
+            hostname = target.raw_host.decode('ascii')
+            host_header = hostname if target.port is None else f"{hostname}:{target.port}"
+            limit = host_limits.setdefault(hostname, asyncio.Semaphore(DEEP_FETCH_PER_HOST))
+            async with limit, http.stream(
+                'GET', target.copy_with(host=address),
+                headers={'Host': host_header},
+                extensions={'sni_hostname': hostname}
+            ) as response:
+                if response.is_redirect:
+                    url = str(target.join(response.headers.get('location', '')))
+                    continue
+                if response.status_code != 200:
+                    return None
+                content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+                if content_type not in DEEP_FETCH_CONTENT_TYPES:
+                    return None
+                chunks = []
+                received = 0
+                async for chunk in response.aiter_bytes():
+                    chunks.append(chunk)
+                    received += len(chunk)
+                    if received >= DEEP_FETCH_MAX_BYTES:
+                        break
+                return b''.join(chunks)[:DEEP_FETCH_MAX_BYTES]
+        return None
+
+    async def deep_fetch_results(self, results: List[Dict]) -> List[Dict]:
+        """Потоковая загрузка найденных страниц и извлечение из них знаний
+
+        Этапы конвейера: адреса -> параллельная загрузка -> HTML в текст ->
+        извлечение знаний в db.knowledge. Этапы связаны ограниченными очередями,
+        поэтому каждая страница обрабатывается сразу после загрузки.
+        """
+        url_queue = asyncio.Queue(maxsize=DEEP_FETCH_QUEUE_SIZE)
+        html_queue = asyncio.Queue(maxsize=DEEP_FETCH_QUEUE_SIZE)
+        text_queue = asyncio.Queue(maxsize=DEEP_FETCH_QUEUE_SIZE)
+        host_limits: Dict[str, asyncio.Semaphore] = {}
+        extractors_count = max(1, min(4, DEEP_FETCH_CONCURRENCY))
+
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        }
+
+        async def produce():
+            for result in results:
+                url = self.resolve_result_url(result.get('url', ''))
+                if url.startswith(('http://', 'https://')):
+                    await url_queue.put((result, url))
+            for _ in range(DEEP_FETCH_CONCURRENCY):
+                await url_queue.put(None)
+
+        async def fetch(http: httpx.AsyncClient):
+            while True:
+                item = await url_queue.get()
+                if item is None:
+                    return
+                result, url = item
+                try:
+                    html = await self.fetch_page(http, url, host_limits)
+                except Exception as e:
+                    print(f"Ошибка загрузки страницы {url}: {e}")
+                    continue
+                if html:
+                    await html_queue.put((result, url, html))
+
+        async def extract():
+            while True:
+                item = await html_queue.get()
+                if item is None:
+                    return
+                result, url, html = item
+                try:
+                    text = await asyncio.to_thread(self.html_to_text, html)
+                except Exception as e:
+                    print(f"Ошибка разбора страницы {url}: {e}")
+                    continue
+                if text:
+                    await text_queue.put((result, url, text))
+
+        async def learn():
+            while True:
+                item = await text_queue.get()
+                if item is None:
+                    return
+                result, url, text = item
+                knowledge = await self.extract_knowledge_from_text(text, '.md')
+                result['page_excerpt'] = text[:500]
+                result['page_knowledge'] = knowledge
+                record = {
+                    "filename": url,
+                    "source": "web",
+                    "timestamp": datetime.now().isoformat(),
+                    "knowledge": knowledge,
+                    "size": len(text)
+                }
+                self.relevance.add_knowledge(record)
+                try:
+                    # Одна запись на страницу: повторный поиск обновляет ее, а не дублирует
+                    await db.knowledge.update_one(
+                        {"filename": url, "source": "web"},
+                        {"$set": record},
+                        upsert=True
+                    )
+                except Exception as e:
+                    print(f"Ошибка сохранения знаний со страницы {url}: {e}")
+
+        async def run_pipeline(http: httpx.AsyncClient):
+            learner = asyncio.create_task(learn())
+            extractors = [asyncio.create_task(extract()) for _ in range(extractors_count)]
+            try:
+                await asyncio.gather(produce(), *[fetch(http) for _ in range(DEEP_FETCH_CONCURRENCY)])
+                for _ in extractors:
+                    await html_queue.put(None)
+                await asyncio.gather(*extractors)
+                await text_queue.put(None)
+                await learner
+            finally:
+                # При таймауте останавливаем этапы, которые еще работают
+                for task in [learner, *extractors]:
+                    task.cancel()
+
+        try:
+            # Соединения не переиспользуются: соединение к IP, открытое с SNI одного
+            # хоста, не должно обслуживать запрос к другому хосту на том же IP.
+            # Прокси из окружения не используются: он разрешал бы имя сам
+            async with httpx.AsyncClient(
+                headers=headers, timeout=10, follow_redirects=False, trust_env=False,
+                limits=httpx.Limits(max_keepalive_connections=0)
+            ) as http:
+                await asyncio.wait_for(run_pipeline(http), timeout=DEEP_FETCH_DEADLINE)
+        except asyncio.TimeoutError:
+            print(f"Глубокий поиск остановлен по таймауту {DEEP_FETCH_DEADLINE} с")
+        except Exception as e:
+            print(f"Ошибка глубокого поиска: {e}")
+        
         return results
 
     async def get_fallback_knowledge(self, query: str) -> List[Dict]:
@@ -292,58 +1392,46 @@ class SelfModifyingAI:
 
     async def extract_knowledge_from_file(self, file_path: str) -> List[str]:
         """Извлечение знаний из загруженного файла"""
-        knowledge = []
-        
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
-            
-            # Простое извлечение ключевых слов и паттернов
-            if file_path.endswith('.py'):
-                # Ищем импорты
-                imports = re.findall(r'(?:from|import)\s+(\w+)', content)
-                knowledge.extend([f"Python модуль: {imp}" for imp in imports[:10]])
-                
-                # Ищем функции
-                functions = re.findall(r'def\s+(\w+)', content)
-                knowledge.extend([f"Python функция: {func}" for func in functions[:5]])
-                
-            elif file_path.endswith(('.js', '.jsx')):
-                # Ищем импорты ES6
-                imports = re.findall(r'import.*from\s+[\'"]([^\'"]+)[\'"]', content)
-                knowledge.extend([f"JavaScript модуль: {imp}" for imp in imports[:10]])
-                
-            elif file_path.endswith(('.txt', '.md')):
-                # Извлекаем ключевые слова из текста
-                words = re.findall(r'\b[a-zA-Zа-яА-Я]{5,}\b', content)
-                # Берем уникальные слова
-                unique_words = list(set(words))[:20]
-                knowledge.extend([f"Ключевое слово: {word}" for word in unique_words])
-            
-            # Общие паттерны
-            urls = re.findall(r'https?://[^\s]+', content)
-            knowledge.extend([f"URL: {url}" for url in urls[:5]])
-            
         except Exception as e:
-            knowledge.append(f"Ошибка обработки файла: {str(e)}")
+            return [f"Ошибка обработки файла: {str(e)}"]
         
-        return knowledge
+        return await self.extract_knowledge_from_text(content, file_path)
+
+    async def extract_knowledge_from_text(self, content: str, file_path: str) -> List[str]:
+        """Извлечение знаний из текста, тип определяется по расширению имени"""
+        return extract_knowledge(content, file_path)
 
-    async def generate_response(self, user_message: str) -> AIResponse:
+    async def generate_response(self, user_message: str, deep_fetch: bool = False) -> AIResponse:
         """Генерация ответа на русском языке"""
         # Поиск информации в интернете
-        search_results = await self.search_web(user_message)
+        with profiler.stage("search_web"):
+            search_results = await self.search_web(user_message, deep_fetch=deep_fetch)
+        
+        # Ранжируем результаты поиска и сохраненные знания по запросу
+        with profiler.stage("relevance"):
+            for result in search_results:
+                self.relevance.add_search_result(result)
+            top_results = await self.relevance.search_async(user_message, RELEVANCE_TOP_K) or search_results[:RELEVANCE_TOP_K]
         
         # Анализ собственного кода
-        code_analysis = await self.analyze_own_code()
+        with profiler.stage("analyze_own_code"):
+            code_analysis = await self.analyze_own_code()
         
         # Формирование ответа
         response_parts = [f"Привет! Я обработал ваш запрос: '{user_message}'"]
         
         if search_results:
-            response_parts.append(f"Нашел {len(search_results)} релевантных результатов в интернете:")
-            for i, result in enumerate(search_results[:3], 1):
+            response_parts.append(f"Нашел {len(search_results)} релевантных результатов в интернете.")
+        
+        if top_results:
+            response_parts.append("Наиболее подходящие материалы:")
+            for i, result in enumerate(top_results, 1):
                 response_parts.append(f"{i}. {result['title']}: {result['snippet'][:100]}...")
+                if result.get('page_excerpt'):
+                    response_parts.append(f"   Со страницы: {result['page_excerpt'][:200]}...")
         
         if code_analysis['potential_improvements']:
             response_parts.append(f"Обнаружил {len(code_analysis['potential_improvements'])} возможностей для улучшения моего кода:")
@@ -353,7 +1441,8 @@ class SelfModifyingAI:
         # Применение улучшений
         improvements_to_apply = code_analysis['potential_improvements'][:2]  # Применяем первые 2
         if improvements_to_apply:
-            modification_result = await self.apply_improvements(improvements_to_apply)
+            with profiler.stage("apply_improvements"):
+                modification_result = await self.apply_improvements(improvements_to_apply)
             if modification_result.success:
                 response_parts.append("✅ Успешно применил улучшения к своему коду!")
             else:
@@ -363,9 +1452,11 @@ class SelfModifyingAI:
         
         # Извлекаем знания из результатов поиска
         knowledge_gained = []
-        for result in search_results[:3]:
+        for result in top_results:
             if 'improvements' in result:
                 knowledge_gained.extend(result['improvements'])
+            if 'page_knowledge' in result:
+                knowledge_gained.extend(result['page_knowledge'][:5])
         
         return AIResponse(
             response=response_text,
@@ -377,6 +1468,378 @@ class SelfModifyingAI:
 # Создаем экземпляр ИИ
 ai_system = SelfModifyingAI()
 
+# Фоновые задачи держим в множестве, иначе сборщик мусора может удалить их до завершения
+background_tasks: set = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    """Запуск фоновой задачи с сохранением ссылки до ее завершения"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Снимки базы знаний
+def current_snapshot_path() -> Optional[str]:
+    """Путь к актуальному снимку (по символической ссылке current)"""
+    link = os.path.join(KNOWLEDGE_SNAPSHOT_DIR, 'current')
+    if not os.path.islink(link):
+        return None
+    return os.path.realpath(link)
+
+def open_current_snapshot() -> Optional[KnowledgeSnapshot]:
+    path = current_snapshot_path()
+    if not path:
+        return None
+    try:
+        return KnowledgeSnapshot(path)
+    except Exception as e:
+        print(f"Ошибка открытия снимка знаний {path}: {e}")
+        return None
+
+def build_knowledge_engine(records: List[Dict], snapshot: Optional[KnowledgeSnapshot] = None) -> RelevanceEngine:
+    """Индексация записей db.knowledge (выполняется вне event loop)"""
+    engine = RelevanceEngine(snapshot)
+    for record in records:
+        engine.add_document(*knowledge_document(record))
+    return engine
+
+def build_knowledge_snapshot(path: str, records: List[Dict], meta: Dict) -> bool:
+    engine = build_knowledge_engine(records)
+    if engine.nnz == 0:
+        return False
+    KnowledgeSnapshot.write(path, engine, meta)
+    return True
+
+async def reload_knowledge_index(index: RelevanceIndex, snapshot: Optional[KnowledgeSnapshot]):
+    """Перестроение слоя знаний поверх снимка: в память читаются только записи новее снимка"""
+    index.start_reload()
+    try:
+        query = {"timestamp": {"$gt": snapshot.meta['watermark']}} if snapshot else {}
+        records = await db.knowledge.find(query, {"filename": 1, "knowledge": 1, "source": 1}).to_list(None)
+        knowledge = await asyncio.to_thread(build_knowledge_engine, records, snapshot)
+    except BaseException:
+        index.pending = None
+        raise
+    index.swap_knowledge(snapshot, knowledge)
+
+async def knowledge_signature() -> Dict:
+    """Признаки изменения db.knowledge: число записей, последний _id и время"""
+    latest_id = await db.knowledge.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    latest_update = await db.knowledge.find_one({}, {"timestamp": 1}, sort=[("timestamp", -1)])
+    return {
+        "records": await db.knowledge.count_documents({}),
+        "last_id": str(latest_id["_id"]) if latest_id else None,
+        "watermark": latest_update.get("timestamp", "") if latest_update else ""
+    }
+
+async def rebuild_knowledge_snapshot() -> Optional[str]:
+    """Сборка нового снимка и атомарная замена ссылки current"""
+    signature = await knowledge_signature()
+    snapshot = open_current_snapshot()
+    if snapshot and all(snapshot.meta.get(key) == value for key, value in signature.items()):
+        return None
+
+    records = await db.knowledge.find({}, {"filename": 1, "knowledge": 1, "source": 1}).to_list(None)
+    name = f"snapshot-{uuid.uuid4().hex}"
+    path = os.path.join(KNOWLEDGE_SNAPSHOT_DIR, name)
+    meta = dict(signature, built_at=datetime.now().isoformat())
+    # Токенизация всей базы и запись файлов идут в отдельном потоке
+    if not await asyncio.to_thread(build_knowledge_snapshot, path, records, meta):
+        return None
+
+    temp_link = os.path.join(KNOWLEDGE_SNAPSHOT_DIR, f".current-{uuid.uuid4().hex}")
+    os.symlink(name, temp_link)
+    os.replace(temp_link, os.path.join(KNOWLEDGE_SNAPSHOT_DIR, 'current'))
+
+    # Оставляем текущий и предыдущий снимки, остальные удаляем
+    keep = {name, os.path.basename(snapshot.path) if snapshot else None}
+    for entry in os.listdir(KNOWLEDGE_SNAPSHOT_DIR):
+        if entry.startswith('snapshot-') and entry not in keep:
+            await asyncio.to_thread(shutil.rmtree, os.path.join(KNOWLEDGE_SNAPSHOT_DIR, entry), True)
+    return path
+
+async def maintain_knowledge_snapshot():
+    """Периодическая пересборка снимка одним воркером и подхват его всеми"""
+    while True:
+        await asyncio.sleep(KNOWLEDGE_SNAPSHOT_INTERVAL)
+        try:
+            with open(os.path.join(KNOWLEDGE_SNAPSHOT_DIR, 'build.lock'), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    pass
+                else:
+                    path = await rebuild_knowledge_snapshot()
+                    if path:
+                        print(f"Собран новый снимок знаний: {path}")
+
+            path = current_snapshot_path()
+            current = ai_system.relevance.snapshot
+            if path and (current is None or current.path != path):
+                await reload_knowledge_index(ai_system.relevance, KnowledgeSnapshot(path))
+        except Exception as e:
+            print(f"Ошибка обновления снимка знаний: {e}")
+
+@app.on_event("startup")
+async def load_relevance_index():
+    """Построение индекса релевантности: снимок с диска плюс новые записи"""
+    try:
+        os.makedirs(KNOWLEDGE_SNAPSHOT_DIR, exist_ok=True)
+        await db.knowledge.create_index("timestamp")
+        await reload_knowledge_index(ai_system.relevance, open_current_snapshot())
+        snapshot = ai_system.relevance.snapshot
+        print(f"Индекс релевантности: {snapshot.documents if snapshot else 0} документов в снимке, "
+              f"{ai_system.relevance.knowledge.documents} в памяти")
+    except Exception as e:
+        print(f"Ошибка построения индекса релевантности: {e}")
+    start_background_task(maintain_knowledge_snapshot())
+
+# История улучшений и сообщений
+def content_hash(data: Any) -> str:
+    """Хэш содержимого, не зависящий от порядка ключей"""
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+def dict_delta(previous: Dict, current: Dict) -> Dict:
+    """Разница между словарями: set - новые значения, unset - удаленные ключи, nested - вложенные разницы"""
+    delta = {}
+    changed = {}
+    nested = {}
+    for key, value in current.items():
+        if key in previous and isinstance(value, dict) and isinstance(previous[key], dict):
+            inner = dict_delta(previous[key], value)
+            if inner:
+                nested[key] = inner
+        elif key not in previous or previous[key] != value:
+            changed[key] = value
+    removed = [key for key in previous if key not in current]
+    if changed:
+        delta['set'] = changed
+    if removed:
+        delta['unset'] = removed
+    if nested:
+        delta['nested'] = nested
+    return delta
+
+def apply_delta(previous: Dict, delta: Dict) -> Dict:
+    """Восстановление словаря по предыдущему значению и разнице"""
+    current = {key: value for key, value in previous.items() if key not in delta.get('unset', [])}
+    current.update(delta.get('set', {}))
+    for key, inner in delta.get('nested', {}).items():
+        current[key] = apply_delta(previous.get(key, {}), inner)
+    return current
+
+async def load_improvements(limit: int) -> List[Dict]:
+    """Последние записи об улучшениях с восстановленными result и analysis
+
+    Запись хранит либо полный result (опорная запись), либо разницу с
+    записью base. Цепочка разниц не длиннее IMPROVEMENTS_KEYFRAME_INTERVAL,
+    поэтому достаточно прочитать limit + IMPROVEMENTS_KEYFRAME_INTERVAL записей.
+    """
+    records = await db.improvements.find().sort("timestamp", -1).limit(limit + IMPROVEMENTS_KEYFRAME_INTERVAL).to_list(None)
+    records.reverse()
+
+    resolved: Dict[Any, Dict] = {}
+    history = []
+    for record in records:
+        if 'result' in record:
+            result = record['result']
+        elif record.get('base') in resolved:
+            result = apply_delta(resolved[record['base']]['result'], record.get('result_delta', {}))
+        else:
+            continue
+        entry = {
+            "id": record['_id'],
+            "timestamp": record.get('timestamp'),
+            "result": result,
+            "analysis": record.get('analysis'),
+            "analysis_hash": record.get('analysis_hash'),
+            "depth": record.get('depth', 0)
+        }
+        resolved[record['_id']] = entry
+        history.append(entry)
+    history = history[-limit:]
+
+    hashes = list({entry['analysis_hash'] for entry in history if entry['analysis'] is None and entry['analysis_hash']})
+    if hashes:
+        snapshots = {}
+        async for snapshot in db.analysis_snapshots.find({"_id": {"$in": hashes}}):
+            snapshots[snapshot['_id']] = snapshot['analysis']
+        for entry in history:
+            if entry['analysis'] is None:
+                entry['analysis'] = snapshots.get(entry['analysis_hash'])
+    return history
+
+async def save_analysis_snapshot(analysis: Dict) -> str:
+    """Сохранение анализа один раз на каждое уникальное содержимое"""
+    analysis_hash = content_hash(analysis)
+    await db.analysis_snapshots.update_one(
+        {"_id": analysis_hash},
+        {"$setOnInsert": {"analysis": analysis, "created": datetime.now().isoformat()}},
+        upsert=True
+    )
+    return analysis_hash
+
+async def store_improvement(analysis: Dict, result: Dict):
+    """Запись об улучшении: хэш анализа и разница результата с прошлым запуском"""
+    record = {
+        "timestamp": datetime.now().isoformat(),
+        "analysis_hash": await save_analysis_snapshot(analysis)
+    }
+    previous = await load_improvements(1)
+    if previous and previous[-1]['depth'] + 1 < IMPROVEMENTS_KEYFRAME_INTERVAL:
+        record.update(
+            base=previous[-1]['id'],
+            depth=previous[-1]['depth'] + 1,
+            result_delta=dict_delta(previous[-1]['result'], result)
+        )
+    else:
+        record.update(depth=0, result=result)
+    await db.improvements.insert_one(record)
+
+async def compact_improvements() -> int:
+    """Перевод старых записей с полным analysis в формат хэш + разница"""
+    legacy = await db.improvements.find({"analysis": {"$exists": True}}).sort("timestamp", 1).to_list(None)
+    operations = []
+    previous = None
+    for i, record in enumerate(legacy):
+        update = {"$set": {"analysis_hash": await save_analysis_snapshot(record['analysis'])}, "$unset": {"analysis": ""}}
+        result = record.get('result', {})
+        # Последняя запись остается опорной: на нее уже могут ссылаться новые записи
+        is_last = i == len(legacy) - 1
+        if previous and previous['depth'] + 1 < IMPROVEMENTS_KEYFRAME_INTERVAL and not is_last:
+            depth = previous['depth'] + 1
+            update["$set"].update(base=previous['id'], depth=depth, result_delta=dict_delta(previous['result'], result))
+            update["$unset"]["result"] = ""
+        else:
+            depth = 0
+            update["$set"]["depth"] = 0
+        operations.append(UpdateOne({"_id": record['_id']}, update))
+        previous = {"id": record['_id'], "result": result, "depth": depth}
+        if len(operations) >= HISTORY_BATCH_SIZE:
+            await db.improvements.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.improvements.bulk_write(operations, ordered=False)
+    return len(legacy)
+
+def parse_timestamp(value: str) -> datetime:
+    """Время из isoformat(); без часового пояса - локальное время сервера (datetime.now())"""
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo else parsed.astimezone()
+
+async def apply_message_retention() -> Dict:
+    """Очистка старых сообщений по MESSAGES_RETENTION_DAYS
+
+    В режиме ttl удалением занимается TTL-индекс MongoDB по полю created_at,
+    здесь оно только заполняется у старых сообщений. В режиме rollup старые
+    сообщения сворачиваются в дневную статистику db.message_rollups и удаляются
+    пачками, см. rollup_message_batch.
+    """
+    if MESSAGES_RETENTION_DAYS <= 0:
+        return {}
+
+    if MESSAGES_RETENTION_MODE == 'ttl':
+        backfilled = 0
+        operations = []
+        async for message in db.messages.find({"created_at": {"$exists": False}}, {"timestamp": 1}):
+            try:
+                created_at = parse_timestamp(message['timestamp'])
+            except (KeyError, TypeError, ValueError):
+                created_at = datetime.now(timezone.utc)
+            operations.append(UpdateOne({"_id": message['_id']}, {"$set": {"created_at": created_at}}))
+            if len(operations) >= HISTORY_BATCH_SIZE:
+                await db.messages.bulk_write(operations, ordered=False)
+                backfilled += len(operations)
+                operations = []
+        if operations:
+            await db.messages.bulk_write(operations, ordered=False)
+            backfilled += len(operations)
+        return {"messages_backfilled": backfilled}
+
+    cutoff = (datetime.now() - timedelta(days=MESSAGES_RETENTION_DAYS)).isoformat()
+    rolled_up = 0
+    # Сначала дозавершаем пачки, прерванные на прошлом запуске
+    for batch_id in await db.messages.distinct("rollup_batch"):
+        rolled_up += await rollup_message_batch(batch_id)
+    while True:
+        batch = await db.messages.find(
+            {"timestamp": {"$lt": cutoff}, "rollup_batch": {"$exists": False}}, {"_id": 1}
+        ).sort("timestamp", 1).limit(HISTORY_BATCH_SIZE).to_list(HISTORY_BATCH_SIZE)
+        if not batch:
+            break
+        batch_id = uuid.uuid4().hex
+        await db.messages.update_many(
+            {"_id": {"$in": [message['_id'] for message in batch]}, "rollup_batch": {"$exists": False}},
+            {"$set": {"rollup_batch": batch_id}}
+        )
+        rolled_up += await rollup_message_batch(batch_id)
+    return {"messages_rolled_up": rolled_up}
+
+async def rollup_message_batch(batch_id: str) -> int:
+    """Свертка помеченной пачки сообщений в дневную статистику
+
+    День запоминает номера учтенных пачек, поэтому повторный запуск после сбоя
+    между $inc и удалением сообщений не учитывает их второй раз.
+    """
+    messages = await db.messages.find({"rollup_batch": batch_id}).to_list(None)
+    days: Dict[str, Counter] = {}
+    for message in messages:
+        stats = days.setdefault(message.get('timestamp', '')[:10], Counter())
+        stats['user_messages' if message.get('type') == 'user' else 'ai_messages'] += 1
+        stats['improvements'] += len(message.get('improvements') or [])
+        stats['knowledge_gained'] += len(message.get('knowledge_gained') or [])
+    for day, stats in days.items():
+        try:
+            await db.message_rollups.update_one(
+                {"_id": day, "batches": {"$ne": batch_id}},
+                {"$inc": dict(stats), "$push": {"batches": batch_id}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # День уже содержит эту пачку, upsert пытался создать его заново
+            pass
+    await db.messages.delete_many({"rollup_batch": batch_id})
+    return len(messages)
+
+async def ensure_history_indexes():
+    await db.messages.create_index("timestamp")
+    await db.messages.create_index("rollup_batch", sparse=True)
+    await db.improvements.create_index("timestamp")
+    if MESSAGES_RETENTION_MODE == 'ttl' and MESSAGES_RETENTION_DAYS > 0:
+        await db.messages.create_index("created_at", expireAfterSeconds=int(MESSAGES_RETENTION_DAYS * 86400))
+
+async def compact_history() -> Dict:
+    """Сжатие истории улучшений и применение политики хранения сообщений"""
+    summary = {"improvements_compacted": await compact_improvements()}
+    summary.update(await apply_message_retention())
+    return summary
+
+async def maintain_history():
+    """Периодическое сжатие истории одним воркером"""
+    while True:
+        try:
+            with open(HISTORY_COMPACTION_LOCK, 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    pass
+                else:
+                    summary = await compact_history()
+                    if any(summary.values()):
+                        print(f"Сжатие истории: {summary}")
+        except Exception as e:
+            print(f"Ошибка сжатия истории: {e}")
+        await asyncio.sleep(HISTORY_COMPACTION_INTERVAL)
+
+@app.on_event("startup")
+async def start_history_maintenance():
+    """Индексы для запросов истории и фоновое сжатие"""
+    try:
+        await ensure_history_indexes()
+    except Exception as e:
+        print(f"Ошибка создания индексов истории: {e}")
+    start_background_task(maintain_history())
+
 # API endpoints
 @app.get("/api/")
 async def root():
@@ -387,23 +1850,28 @@ async def chat_with_ai(message: ChatMessage):
     """Общение с ИИ"""
     try:
         # Сохраняем сообщение в базу данных
-        await db.messages.insert_one({
-            "user_message": message.message,
-            "timestamp": datetime.now().isoformat(),
-            "type": "user"
-        })
+        with profiler.stage("db.messages"):
+            await db.messages.insert_one({
+                "user_message": message.message,
+                "timestamp": datetime.now().isoformat(),
+                "created_at": datetime.now(timezone.utc),
+                "type": "user"
+            })
         
         # Генерируем ответ ИИ
-        ai_response = await ai_system.generate_response(message.message)
+        with profiler.stage("generate_response"):
+            ai_response = await ai_system.generate_response(message.message, message.deep_fetch)
         
         # Сохраняем ответ ИИ
-        await db.messages.insert_one({
-            "ai_response": ai_response.response,
-            "timestamp": ai_response.timestamp,
-            "type": "ai",
-            "improvements": ai_response.improvements,
-            "knowledge_gained": ai_response.knowledge_gained
-        })
+        with profiler.stage("db.messages"):
+            await db.messages.insert_one({
+                "ai_response": ai_response.response,
+                "timestamp": ai_response.timestamp,
+                "created_at": datetime.now(timezone.utc),
+                "type": "ai",
+                "improvements": ai_response.improvements,
+                "knowledge_gained": ai_response.knowledge_gained
+            })
         
         return ai_response
         
@@ -414,7 +1882,7 @@ async def chat_with_ai(message: ChatMessage):
 async def search_internet(query: SearchQuery):
     """Поиск информации в интернете"""
     try:
-        results = await ai_system.search_web(query.query, query.max_results)
+        results = await ai_system.search_web(query.query, query.max_results, query.deep_fetch)
         return {"results": results, "count": len(results)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка поиска: {str(e)}")
@@ -439,11 +1907,7 @@ async def apply_improvements():
         result = await ai_system.apply_improvements(analysis['potential_improvements'])
         
         # Сохраняем в историю
-        await db.improvements.insert_one({
-            "timestamp": datetime.now().isoformat(),
-            "result": result.dict(),
-            "analysis": analysis
-        })
+        await store_improvement(analysis, result.dict())
         
         return result
         
@@ -454,7 +1918,7 @@ async def apply_improvements():
 async def get_chat_history():
     """Получение истории чата"""
     try:
-        messages = await db.messages.find().sort("timestamp", -1).limit(50).to_list(50)
+        messages = await db.messages.find({}, {"_id": 0}).sort("timestamp", -1).limit(50).to_list(50)
         return {"messages": messages}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения истории: {str(e)}")
@@ -463,15 +1927,222 @@ async def get_chat_history():
 async def get_improvements_history():
     """Получение истории улучшений"""
     try:
-        improvements = await db.improvements.find().sort("timestamp", -1).limit(20).to_list(20)
-        return {"improvements": improvements}
+        improvements = await load_improvements(20)
+        return {"improvements": [
+            {"timestamp": entry['timestamp'], "result": entry['result'], "analysis": entry['analysis']}
+            for entry in reversed(improvements)
+        ]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка получения истории улучшений: {str(e)}")
 
+# Обработка архивов со знаниями
+knowledge_pool: Optional[ProcessPoolExecutor] = None
+
+def get_knowledge_pool() -> ProcessPoolExecutor:
+    global knowledge_pool
+    if knowledge_pool is None:
+        # forkserver: fork процесса с потоками motor, to_thread и профайлера небезопасен
+        knowledge_pool = ProcessPoolExecutor(max_workers=ARCHIVE_WORKERS, mp_context=multiprocessing.get_context('forkserver'))
+    return knowledge_pool
+
+def reset_knowledge_pool(pool: ProcessPoolExecutor):
+    """Остановка сломанного пула, следующий get_knowledge_pool создаст новый"""
+    global knowledge_pool
+    if knowledge_pool is pool:
+        knowledge_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def shutdown_knowledge_pool():
+    if knowledge_pool is not None:
+        reset_knowledge_pool(knowledge_pool)
+
+async def create_archive_job(filename: str) -> Dict:
+    """Задача обработки архива в db.archive_jobs, видна всем воркерам"""
+    now = datetime.now().isoformat()
+    job = {
+        "id": uuid.uuid4().hex,
+        "filename": filename,
+        "status": "processing",
+        "stage": "checking",
+        "started": now,
+        "updated": now,
+        "finished": None,
+        "members_read": 0,
+        "members_processed": 0,
+        "members_skipped": 0,
+        "members_failed": 0,
+        "bytes_read": 0,
+        "knowledge_extracted": 0,
+        "error": None
+    }
+    await db.archive_jobs.insert_one(dict(job, _id=job["id"]))
+    # Храним только последние ARCHIVE_JOBS_LIMIT задач
+    old = await db.archive_jobs.find({}, {"_id": 1}).sort("started", -1).skip(ARCHIVE_JOBS_LIMIT).to_list(None)
+    if old:
+        await db.archive_jobs.delete_many({"_id": {"$in": [entry["_id"] for entry in old]}})
+    return job
+
+async def save_archive_job(job: Dict):
+    job["updated"] = datetime.now().isoformat()
+    await db.archive_jobs.update_one({"_id": job["id"]}, {"$set": {key: value for key, value in job.items() if key != "id"}})
+
+async def report_archive_progress(job: Dict):
+    """Периодическая запись прогресса, пока задача выполняется"""
+    while True:
+        await asyncio.sleep(ARCHIVE_PROGRESS_INTERVAL)
+        try:
+            await save_archive_job(job)
+        except Exception as e:
+            print(f"Ошибка сохранения прогресса архива {job['filename']}: {e}")
+
+async def process_knowledge_archive(job: Dict, archive_path: str):
+    """Извлечение знаний из архива
+
+    Сначала архив целиком проверяется на лимиты, поэтому архив сверх лимитов
+    не оставляет в базе ни одной записи. Затем поток читает файлы архива
+    и кладет их в ограниченную очередь, асинхронные обработчики отправляют
+    их в пул процессов, а готовые записи сохраняются в db.knowledge пачками
+    через insert_many. Если обработчики остановились, событие stop прерывает
+    поток чтения, чтобы он не ждал место в очереди вечно.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=ARCHIVE_WORKERS * 2)
+    stop = threading.Event()
+    batch: List[Dict] = []
+    batch_lock = asyncio.Lock()
+    archive_name = job["filename"]
+
+    def put(item) -> bool:
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return True
+            except FutureTimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+
+    def read_members():
+        try:
+            for member_name, data in iter_knowledge_members(archive_path, archive_name, job):
+                if stop.is_set():
+                    return
+                job["members_read"] += 1
+                if not put((member_name, data)):
+                    return
+        finally:
+            for _ in range(ARCHIVE_WORKERS):
+                if not put(None):
+                    break
+
+    async def flush():
+        # Пачка очищается только после успешной записи, при ошибке она уйдет со следующей
+        async with batch_lock:
+            if not batch:
+                return
+            records = batch[:]
+            try:
+                await db.knowledge.insert_many(records, ordered=False)
+            except BulkWriteError as e:
+                # Записи, вставленные при прошлой неудачной попытке, дают ошибку дубликата
+                if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                    raise
+            del batch[:len(records)]
+            for record in records:
+                ai_system.relevance.add_knowledge(record)
+
+    async def work():
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                member_name, data = item
+                pool = get_knowledge_pool()
+                try:
+                    text = data.decode('utf-8', errors='replace')
+                    knowledge = await loop.run_in_executor(pool, extract_knowledge, text, member_name)
+                    batch.append({
+                        "filename": f"{archive_name}/{member_name}",
+                        "archive": archive_name,
+                        "timestamp": datetime.now().isoformat(),
+                        "knowledge": knowledge,
+                        "size": len(data)
+                    })
+                    job["members_processed"] += 1
+                    job["knowledge_extracted"] += len(knowledge)
+                except BrokenProcessPool as e:
+                    reset_knowledge_pool(pool)
+                    job["members_failed"] += 1
+                    job["error"] = f"{member_name}: {e}"
+                except Exception as e:
+                    job["members_failed"] += 1
+                    job["error"] = f"{member_name}: {e}"
+                if len(batch) >= ARCHIVE_INSERT_BATCH:
+                    await flush()
+        except BaseException:
+            # Без обработчиков очередь не освободится, поток чтения должен остановиться
+            stop.set()
+            raise
+
+    reporter = asyncio.create_task(report_archive_progress(job))
+    workers = []
+    try:
+        await asyncio.to_thread(check_archive_limits, archive_path, archive_name)
+        job["stage"] = "extracting"
+        workers = [asyncio.create_task(work()) for _ in range(ARCHIVE_WORKERS)]
+        try:
+            await asyncio.to_thread(read_members)
+        finally:
+            if stop.is_set():
+                for worker in workers:
+                    worker.cancel()
+            results = await asyncio.gather(*workers, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        await flush()
+        job["status"] = "error" if job["error"] else "done"
+    except Exception as e:
+        job["status"] = "error"
+        job["error"] = str(e)
+        if job["stage"] == "extracting":
+            try:
+                await flush()
+            except Exception as flush_error:
+                print(f"Ошибка сохранения знаний из архива {archive_name}: {flush_error}")
+    finally:
+        stop.set()
+        reporter.cancel()
+        for worker in workers:
+            worker.cancel()
+        if job["status"] == "processing":
+            job["status"] = "error"
+            job["error"] = job["error"] or "Обработка прервана"
+        job["finished"] = datetime.now().isoformat()
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        try:
+            await save_archive_job(job)
+        except Exception as e:
+            print(f"Ошибка сохранения задачи архива {archive_name}: {e}")
+
 @app.post("/api/upload-knowledge")
 async def upload_knowledge_file(file: UploadFile = File(...)):
     """Загрузка файла для обучения ИИ"""
     try:
+        if file.filename.lower().endswith(ARCHIVE_EXTENSIONS):
+            # Архив сохраняем во временный файл кусками и обрабатываем в фоне
+            job = await create_archive_job(file.filename)
+            archive_path = f"/tmp/archive-{job['id']}"
+            async with aiofiles.open(archive_path, 'wb') as f:
+                while chunk := await file.read(1024 * 1024):
+                    await f.write(chunk)
+            start_background_task(process_knowledge_archive(job, archive_path))
+            return {"message": f"Архив {file.filename} принят в обработку", "job_id": job["id"]}
+        
         # Читаем содержимое файла
         content = await file.read()
         
@@ -484,18 +2155,80 @@ async def upload_knowledge_file(file: UploadFile = File(...)):
         knowledge = await ai_system.extract_knowledge_from_file(file_path)
         
         # Сохраняем в базу знаний
-        await db.knowledge.insert_one({
+        record = {
             "filename": file.filename,
             "timestamp": datetime.now().isoformat(),
             "knowledge": knowledge,
             "size": len(content)
-        })
+        }
+        await db.knowledge.insert_one(record)
+        ai_system.relevance.add_knowledge(record)
         
         return {"message": f"Файл {file.filename} успешно загружен и проанализирован", "knowledge_extracted": len(knowledge)}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки файла: {str(e)}")
 
+@app.get("/api/upload-knowledge/{job_id}")
+async def get_archive_progress(job_id: str):
+    """Прогресс обработки загруженного архива"""
+    job = await db.archive_jobs.find_one({"_id": job_id}, {"_id": 0})
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    # Прогресс не обновлялся давно: воркер, который вел задачу, остановился
+    updated = datetime.fromisoformat(job["updated"])
+    if job["status"] == "processing" and datetime.now() - updated > timedelta(seconds=ARCHIVE_PROGRESS_INTERVAL * 30):
+        job.update(status="error", error="Обработка прервана")
+    return job
+
+@app.post("/api/admin/compact-history")
+async def run_history_compaction(x_admin_token: Optional[str] = Header(None)):
+    """Немедленное сжатие истории улучшений и сообщений"""
+    check_admin_token(x_admin_token)
+    try:
+        return await compact_history()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка сжатия истории: {str(e)}")
+
+@app.get("/api/admin/circuit-breakers")
+async def get_circuit_breakers(x_admin_token: Optional[str] = Header(None)):
+    """Состояние и метрики предохранителей внешних сервисов"""
+    check_admin_token(x_admin_token)
+    return {"breakers": [ai_system.search_breaker.status()]}
+
+@app.get("/api/admin/profiler")
+async def get_profiler_status(x_admin_token: Optional[str] = Header(None)):
+    """Состояние профайлера и список последних профилей"""
+    check_admin_token(x_admin_token)
+    return {
+        "enabled": profiler.enabled,
+        "sample_rate": profiler.sample_rate,
+        "active": len(profiler.active),
+        "profiles": [profile.summary() for profile in reversed(profiler.profiles)]
+    }
+
+@app.post("/api/admin/profiler")
+async def update_profiler_settings(settings: ProfilerSettings, x_admin_token: Optional[str] = Header(None)):
+    """Включение профилирования для доли запросов"""
+    check_admin_token(x_admin_token)
+    if settings.sample_rate is not None:
+        if not 0 <= settings.sample_rate <= 1:
+            raise HTTPException(status_code=400, detail="sample_rate должен быть от 0 до 1")
+        profiler.sample_rate = settings.sample_rate
+    profiler.enabled = settings.enabled
+    return {"enabled": profiler.enabled, "sample_rate": profiler.sample_rate}
+
+@app.get("/api/admin/profiler/{profile_id}")
+async def download_profile(profile_id: str, x_admin_token: Optional[str] = Header(None)):
+    """Скачивание профиля в формате свернутых стеков"""
+    check_admin_token(x_admin_token)
+    profile = profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Профиль не найден")
+    return PlainTextResponse(profile.folded(), headers={
+        "Content-Disposition": f'attachment; filename="profile-{profile.id}.folded"'
+    })
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from server import KnowledgeSnapshot, RelevanceIndex
+
+class RelevanceBenchmark:
+    def __init__(self, vocabulary_size=50000, words_per_document=20, queries=100, seed=42):
+        self.vocabulary_size = vocabulary_size
+        self.words_per_document = words_per_document
+        self.queries = queries
+        self.random = np.random.default_rng(seed)
+
+    def random_texts(self, count):
+        """Генерация синтетических документов с распределением слов по Ципфу"""
+        word_ids = self.random.zipf(1.3, size=(count, self.words_per_document)) % self.vocabulary_size
+        return [' '.join(f"w{word_id}" for word_id in row) for row in word_ids]
+
+    def run(self, documents_count):
+        """Замер индексации и поиска для заданного числа документов"""
+        index = RelevanceIndex()
+        engine = index.knowledge
+        texts = self.random_texts(documents_count)
+
+        start = time.perf_counter()
+        for i, text in enumerate(texts):
+            engine.add_document(f"doc:{i}", text, {'title': f"Документ {i}", 'snippet': text})
+        index_time = time.perf_counter() - start
+
+        # Первый запрос включает пересчет весов после индексации
+        start = time.perf_counter()
+        index.search(texts[0])
+        first_query_time = time.perf_counter() - start
+
+        queries = self.random_texts(self.queries)
+        start = time.perf_counter()
+        for query in queries:
+            index.search(query, 3)
+        query_time = (time.perf_counter() - start) / len(queries)
+
+        # Путь /api/chat: перед каждым поиском в индекс попадают новые сниппеты
+        snippets = self.random_texts(self.queries * 3)
+        start = time.perf_counter()
+        for i, query in enumerate(queries):
+            for j in range(3):
+                index.add_search_result({'title': f"Сниппет {i}-{j}", 'snippet': snippets[i * 3 + j], 'url': f"https://example.com/{documents_count}/{i}/{j}"})
+            index.search(query, 3)
+        chat_time = (time.perf_counter() - start) / len(queries)
+
+        # Рабочий путь после запуска: те же знания в снимке на диске (mmap)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot')
+            start = time.perf_counter()
+            KnowledgeSnapshot.write(path, engine, {})
+            snapshot_write_time = time.perf_counter() - start
+            snapshot_index = RelevanceIndex(KnowledgeSnapshot(path))
+            start = time.perf_counter()
+            for query in queries:
+                snapshot_index.search(query, 3)
+            snapshot_query_time = (time.perf_counter() - start) / len(queries)
+            del snapshot_index
+
+        print(f"📚 Документов: {documents_count}")
+        print(f"   Индексация: {index_time:.2f} с ({documents_count / index_time:.0f} док/с)")
+        print(f"   Первый запрос: {first_query_time * 1000:.1f} мс")
+        print(f"   Средний запрос: {query_time * 1000:.1f} мс")
+        print(f"   Запрос чата (3 новых сниппета + поиск): {chat_time * 1000:.1f} мс")
+        print(f"   Запись снимка: {snapshot_write_time:.2f} с")
+        print(f"   Запрос по снимку: {snapshot_query_time * 1000:.1f} мс")
+        print(f"   Ненулевых элементов: {engine.nnz}, терминов: {len(engine.vocabulary)}")
+        print()
+
+def main():
+    """Главная функция"""
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    benchmark = RelevanceBenchmark()
+    print("🚀 Бенчмарк ранжирования TF-IDF")
+    print("=" * 60)
+    for size in sizes:
+        benchmark.run(size)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,7 @@ import json
 import time
 from datetime import datetime
 import io
+import zipfile
 
 class SelfModifyingAITester:
     def __init__(self, base_url="https://53442b09-298b-49f6-b059-db71e17141a1.preview.emergentagent.com"):
@@ -215,6 +216,40 @@ if __name__ == "__main__":
         
         return success
 
+    def test_archive_upload(self):
+        """Тест загрузки архива со знаниями"""
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zf:
+            zf.writestr('project/main.py', "import os\n\ndef main():\n    return os.getcwd()\n")
+            zf.writestr('project/README.md', "Документация проекта: https://example.com/docs\n")
+            zf.writestr('project/logo.png', b'binary')
+        archive.seek(0)
+        
+        files = {'file': ('test_knowledge.zip', archive, 'application/zip')}
+        
+        success, response = self.test_api_endpoint(
+            "Загрузка архива знаний",
+            "POST",
+            "upload-knowledge",
+            200,
+            files=files
+        )
+        
+        if not success or 'job_id' not in response:
+            return False
+        
+        # Ждем завершения обработки архива
+        job = {}
+        for _ in range(30):
+            job = self.session.get(f"{self.base_url}/api/upload-knowledge/{response['job_id']}", timeout=30).json()
+            if job.get('status') != 'processing':
+                break
+            time.sleep(1)
+        
+        success = job.get('status') == 'done' and job.get('members_processed') == 2 and job.get('members_skipped') == 1
+        self.log_test("Обработка архива знаний", success, f"Статус: {job.get('status')}, файлов: {job.get('members_processed')}, пропущено: {job.get('members_skipped')}")
+        return success
+
     def test_chat_history(self):
         """Тест получения истории чата"""
         success, response = self.test_api_endpoint("История чата", "GET", "history")
@@ -271,6 +306,7 @@ if __name__ == "__main__":
             ("Применение улучшений", self.test_apply_improvements),
             ("Поиск в интернете", self.test_internet_search),
             ("Загрузка файлов", self.test_file_upload),
+            ("Загрузка архивов", self.test_archive_upload),
             ("История чата", self.test_chat_history),
             ("История улучшений", self.test_improvements_history),
         ]
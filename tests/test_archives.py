@@ -0,0 +1,99 @@
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server
+from server import check_archive_limits, extract_knowledge, iter_archive_members, iter_knowledge_members
+
+
+FILES = {
+    'docs/README.md': b'Python asyncio https://docs.python.org',
+    'src/APP.PY': b'import os\ndef main():\n    pass\n',
+    'logo.png': b'\x89PNG',
+}
+
+
+class ArchiveMembersTest(unittest.TestCase):
+    """Потоковое чтение zip и tar.gz и лимиты на содержимое архива"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def make_zip(self, name='knowledge.zip', files=FILES):
+        path = os.path.join(self.directory, name)
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr('docs/', b'')
+            for member_name, data in files.items():
+                archive.writestr(member_name, data)
+        return path
+
+    def make_tar(self, name='knowledge.tar.gz', files=FILES):
+        path = os.path.join(self.directory, name)
+        with tarfile.open(path, 'w:gz') as archive:
+            for member_name, data in files.items():
+                info = tarfile.TarInfo(member_name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        return path
+
+    def members(self, path, name):
+        return {member_name: stream.read() for member_name, stream in iter_archive_members(path, name)}
+
+    def knowledge_members(self, path, name):
+        progress = {'members_skipped': 0, 'bytes_read': 0}
+        return dict(iter_knowledge_members(path, name, progress)), progress
+
+    def test_zip_members(self):
+        self.assertEqual(self.members(self.make_zip(), 'knowledge.zip'), FILES)
+
+    def test_tar_members(self):
+        self.assertEqual(self.members(self.make_tar(), 'knowledge.tar.gz'), FILES)
+
+    def test_archive_type_ignores_case(self):
+        self.assertEqual(self.members(self.make_zip('B.ZIP'), 'B.ZIP'), FILES)
+        self.assertEqual(self.members(self.make_tar('B.TGZ'), 'B.TGZ'), FILES)
+
+    def test_knowledge_members_filter_by_extension(self):
+        for path, name in ((self.make_zip(), 'knowledge.zip'), (self.make_tar(), 'knowledge.tar.gz')):
+            members, progress = self.knowledge_members(path, name)
+            self.assertEqual(set(members), {'docs/README.md', 'src/APP.PY'})
+            self.assertEqual(progress['members_skipped'], 1)
+            self.assertEqual(progress['bytes_read'], len(FILES['docs/README.md']) + len(FILES['src/APP.PY']))
+
+    def test_member_limit(self):
+        for path, name in ((self.make_zip(), 'knowledge.zip'), (self.make_tar(), 'knowledge.tar.gz')):
+            with mock.patch.object(server, 'ARCHIVE_MAX_MEMBERS', 2):
+                with self.assertRaisesRegex(ValueError, 'Слишком много файлов'):
+                    self.knowledge_members(path, name)
+                with self.assertRaises(ValueError):
+                    check_archive_limits(path, name)
+            with mock.patch.object(server, 'ARCHIVE_MAX_MEMBERS', 3):
+                check_archive_limits(path, name)
+
+    def test_byte_limit_counts_real_data(self):
+        files = {'a.txt': b'x' * 60, 'b.txt': b'y' * 60}
+        for path, name in ((self.make_zip(files=files), 'knowledge.zip'), (self.make_tar(files=files), 'knowledge.tar.gz')):
+            with mock.patch.object(server, 'ARCHIVE_MAX_BYTES', 100):
+                with self.assertRaisesRegex(ValueError, 'Превышен лимит'):
+                    self.knowledge_members(path, name)
+            with mock.patch.object(server, 'ARCHIVE_MAX_BYTES', 120):
+                members, progress = self.knowledge_members(path, name)
+                self.assertEqual(progress['bytes_read'], 120)
+
+    def test_extract_knowledge_ignores_extension_case(self):
+        knowledge = extract_knowledge(FILES['src/APP.PY'].decode(), 'src/APP.PY')
+        self.assertIn('Python модуль: os', knowledge)
+        self.assertIn('Python функция: main', knowledge)
+
+
+if __name__ == '__main__':
+    unittest.main()
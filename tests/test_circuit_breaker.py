@@ -0,0 +1,119 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server
+from server import CircuitBreaker
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Переходы состояний предохранителя closed -> open -> half_open"""
+
+    def setUp(self):
+        self.now = 1000.0
+        patches = [
+            mock.patch.object(server, 'CIRCUIT_WINDOW', 10),
+            mock.patch.object(server, 'CIRCUIT_MIN_CALLS', 4),
+            mock.patch.object(server, 'CIRCUIT_ERROR_RATE', 0.5),
+            mock.patch.object(server, 'CIRCUIT_SLOW_CALL', 2.0),
+            mock.patch.object(server, 'CIRCUIT_SLOW_RATE', 0.5),
+            mock.patch.object(server, 'CIRCUIT_OPEN_SECONDS', 30.0),
+            mock.patch.object(server, 'CIRCUIT_HALF_OPEN_PROBES', 1),
+            mock.patch.object(server.time, 'monotonic', lambda: self.now),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.breaker = CircuitBreaker('test')
+
+    def call(self, success=True, latency=0.1):
+        generation = self.breaker.allow()
+        self.assertIsNotNone(generation)
+        self.breaker.record(generation, success, latency)
+
+    def open_breaker(self):
+        for _ in range(4):
+            self.call(success=False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_stays_closed_below_min_calls(self):
+        for _ in range(3):
+            self.call(success=False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_opens_on_error_rate(self):
+        self.call()
+        self.call()
+        self.call(success=False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.call(success=False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_opens_on_slow_call_rate(self):
+        self.call()
+        self.call()
+        self.call(latency=5.0)
+        self.call(latency=5.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_open_short_circuits(self):
+        self.open_breaker()
+        self.now += 10
+        self.assertIsNone(self.breaker.allow())
+        self.assertEqual(self.breaker.metrics['short_circuited'], 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_probe_success_closes(self):
+        self.open_breaker()
+        self.now += 30
+        generation = self.breaker.allow()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        # Пока идет пробный вызов, остальные уходят в резервный путь
+        self.assertIsNone(self.breaker.allow())
+        self.breaker.record(generation, True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(self.breaker.window), 0)
+
+    def test_half_open_probe_failure_reopens(self):
+        self.open_breaker()
+        self.now += 30
+        generation = self.breaker.allow()
+        self.breaker.record(generation, False, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.opened_at, self.now)
+
+    def test_half_open_slow_probe_reopens(self):
+        self.open_breaker()
+        self.now += 30
+        generation = self.breaker.allow()
+        self.breaker.record(generation, True, 5.0)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_stale_result_ignored(self):
+        stale = self.breaker.allow()
+        self.open_breaker()
+        self.now += 30
+        probe = self.breaker.allow()
+        # Успешный ответ на запрос, начатый до открытия, не закрывает предохранитель
+        self.breaker.record(stale, True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(self.breaker.metrics['stale_results'], 1)
+        self.breaker.record(probe, True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stale_failure_does_not_reopen(self):
+        stale = self.breaker.allow()
+        self.open_breaker()
+        self.now += 30
+        self.breaker.record(self.breaker.allow(), True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record(stale, False, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(self.breaker.window), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
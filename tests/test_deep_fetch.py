@@ -0,0 +1,128 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import httpx
+
+import server
+from server import SelfModifyingAI
+
+
+class PublicUrlTest(unittest.TestCase):
+    """Проверка адресов перед загрузкой страниц (защита от SSRF)"""
+
+    def setUp(self):
+        self.ai = SelfModifyingAI()
+
+    def is_public(self, url):
+        return asyncio.run(self.ai.is_public_url(url))
+
+    def test_rejects_loopback(self):
+        for url in ('http://127.0.0.1/', 'http://localhost:8001/api/admin/profiler', 'http://[::1]/'):
+            self.assertFalse(self.is_public(url), url)
+
+    def test_rejects_private_and_link_local(self):
+        for url in ('http://10.0.0.5/', 'http://192.168.1.1/', 'https://172.16.0.1/',
+                    'http://169.254.169.254/latest/meta-data/', 'http://[fe80::1]/', 'http://0.0.0.0/'):
+            self.assertFalse(self.is_public(url), url)
+
+    def test_rejects_non_http(self):
+        for url in ('ftp://93.184.216.34/', 'file:///etc/passwd', 'javascript:alert(1)', 'http://', '//93.184.216.34/'):
+            self.assertFalse(self.is_public(url), url)
+
+    def test_accepts_public_address(self):
+        self.assertTrue(self.is_public('https://93.184.216.34/page'))
+
+    def test_any_private_record_rejects_host(self):
+        records = [(2, 1, 6, '', ('93.184.216.34', 80)), (2, 1, 6, '', ('127.0.0.1', 80))]
+
+        async def check():
+            loop = asyncio.get_running_loop()
+            with mock.patch.object(loop, 'getaddrinfo', mock.AsyncMock(return_value=records)):
+                return await self.ai.is_public_url('http://rebind.example/')
+
+        self.assertFalse(asyncio.run(check()))
+
+
+class FetchPageTest(unittest.TestCase):
+    """Загрузка страниц: подключение к проверенному IP, редиректы и тип содержимого"""
+
+    def setUp(self):
+        self.ai = SelfModifyingAI()
+        self.addresses = {'example.com': '93.184.216.34', 'other.org': '93.184.216.35'}
+        self.requests = []
+
+    async def public_address(self, url):
+        parsed = httpx.URL(url)
+        return self.addresses.get(parsed.host) if parsed.scheme in ('http', 'https') else None
+
+    def fetch(self, url, handler, host_limits=None):
+        def record(request):
+            self.requests.append(request)
+            return handler(request)
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(record), follow_redirects=False) as http:
+                return await self.ai.fetch_page(http, url, host_limits)
+
+        with mock.patch.object(self.ai, 'public_address', self.public_address):
+            return asyncio.run(run())
+
+    def test_connects_to_checked_address(self):
+        html = self.fetch('https://example.com/page', lambda request: httpx.Response(
+            200, headers={'content-type': 'text/html; charset=utf-8'}, content=b'<p>ok</p>'
+        ))
+        self.assertEqual(html, b'<p>ok</p>')
+        request = self.requests[0]
+        self.assertEqual(request.url.host, '93.184.216.34')
+        self.assertEqual(request.headers['host'], 'example.com')
+        self.assertEqual(request.extensions['sni_hostname'], 'example.com')
+
+    def test_redirect_to_private_host_is_refused(self):
+        self.addresses['internal.example'] = None
+        html = self.fetch('https://example.com/', lambda request: httpx.Response(
+            302, headers={'location': 'http://internal.example/admin'}
+        ))
+        self.assertIsNone(html)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_redirect_takes_limit_of_each_host(self):
+        def handler(request):
+            if request.headers['host'] == 'example.com':
+                return httpx.Response(301, headers={'location': 'https://other.org/final'})
+            return httpx.Response(200, headers={'content-type': 'text/html'}, content=b'final')
+
+        host_limits = {}
+        self.assertEqual(self.fetch('https://example.com/start', handler, host_limits), b'final')
+        self.assertEqual(set(host_limits), {'example.com', 'other.org'})
+        self.assertEqual(self.requests[1].url.host, '93.184.216.35')
+        self.assertEqual(self.requests[1].url.path, '/final')
+
+    def test_non_html_is_rejected(self):
+        html = self.fetch('https://example.com/file.pdf', lambda request: httpx.Response(
+            200, headers={'content-type': 'application/pdf'}, content=b'%PDF'
+        ))
+        self.assertIsNone(html)
+
+    def test_body_is_limited(self):
+        with mock.patch.object(server, 'DEEP_FETCH_MAX_BYTES', 10):
+            html = self.fetch('https://example.com/', lambda request: httpx.Response(
+                200, headers={'content-type': 'text/html'}, content=b'x' * 100
+            ))
+        self.assertEqual(html, b'x' * 10)
+
+    def test_too_many_redirects(self):
+        with mock.patch.object(server, 'DEEP_FETCH_MAX_REDIRECTS', 2):
+            html = self.fetch('https://example.com/', lambda request: httpx.Response(
+                302, headers={'location': '/again'}
+            ))
+        self.assertIsNone(html)
+        self.assertEqual(len(self.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+import asyncio
+import copy
+import os
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+import server
+from server import apply_delta, dict_delta
+
+
+def matches(document, query):
+    """Проверка документа по подмножеству фильтров MongoDB, которое нужно истории"""
+    for key, condition in query.items():
+        present = key in document
+        value = document.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == '$in' and value not in operand:
+                return False
+            if operator == '$exists' and present != operand:
+                return False
+            if operator == '$lt' and not (present and value < operand):
+                return False
+            if operator == '$ne' and (operand == value or (isinstance(value, list) and operand in value)):
+                return False
+    return True
+
+
+def apply_update(document, update, inserting=False):
+    for key, value in update.get('$set', {}).items():
+        document[key] = value
+    if inserting:
+        document.update(update.get('$setOnInsert', {}))
+    for key in update.get('$unset', {}):
+        document.pop(key, None)
+    for key, value in update.get('$inc', {}).items():
+        document[key] = document.get(key, 0) + value
+    for key, value in update.get('$push', {}).items():
+        document.setdefault(key, []).append(value)
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, key, direction=1):
+        self.documents.sort(key=lambda document: document.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self.documents = self.documents[:count]
+        return self
+
+    async def to_list(self, length):
+        return self.documents if length is None else self.documents[:length]
+
+    def __aiter__(self):
+        self.iterator = iter(self.documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    """Коллекция в памяти с асинхронным интерфейсом motor"""
+
+    def __init__(self):
+        self.documents = []
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([copy.deepcopy(document) for document in self.documents if matches(document, query or {})])
+
+    async def insert_one(self, document):
+        document.setdefault('_id', ObjectId())
+        if any(existing['_id'] == document['_id'] for existing in self.documents):
+            raise DuplicateKeyError("duplicate _id")
+        self.documents.append(copy.deepcopy(document))
+
+    async def update_one(self, query, update, upsert=False):
+        for document in self.documents:
+            if matches(document, query):
+                apply_update(document, update)
+                return
+        if upsert:
+            document = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            apply_update(document, update, inserting=True)
+            await self.insert_one(document)
+
+    async def update_many(self, query, update):
+        for document in self.documents:
+            if matches(document, query):
+                apply_update(document, update)
+
+    async def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            await self.update_one(operation._filter, operation._doc, upsert=bool(operation._upsert))
+
+    async def delete_many(self, query):
+        self.documents = [document for document in self.documents if not matches(document, query)]
+
+    async def distinct(self, key):
+        return list({document[key] for document in self.documents if key in document})
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+class DictDeltaTest(unittest.TestCase):
+    """Разница словарей восстанавливается в исходное значение"""
+
+    def assertRoundTrip(self, previous, current):
+        self.assertEqual(apply_delta(previous, dict_delta(previous, current)), current)
+
+    def test_equal_dicts_give_empty_delta(self):
+        self.assertEqual(dict_delta({'a': 1, 'b': {'c': 2}}, {'a': 1, 'b': {'c': 2}}), {})
+
+    def test_changed_added_and_removed_keys(self):
+        self.assertRoundTrip({'a': 1, 'b': 2}, {'a': 3, 'c': 4})
+
+    def test_nested_dicts(self):
+        previous = {'stats': {'functions': 10, 'classes': {'count': 2, 'names': ['A', 'B']}}, 'keep': True}
+        current = {'stats': {'functions': 11, 'classes': {'count': 3, 'names': ['A', 'B', 'C']}}, 'keep': True}
+        delta = dict_delta(previous, current)
+        self.assertNotIn('keep', delta.get('set', {}))
+        self.assertRoundTrip(previous, current)
+
+    def test_type_changes(self):
+        self.assertRoundTrip({'a': {'x': 1}}, {'a': 5})
+        self.assertRoundTrip({'a': 5}, {'a': {'x': 1}})
+
+    def test_removed_nested_keys_and_empty_values(self):
+        self.assertRoundTrip({'a': {'x': 1, 'y': 2}}, {'a': {'x': 1}})
+        self.assertRoundTrip({'a': {'x': 1}}, {})
+        self.assertRoundTrip({'a': {'b': {}}}, {'a': {'b': {'c': 1}}})
+        self.assertRoundTrip({}, {'a': {'b': {}}})
+
+
+class ParseTimestampTest(unittest.TestCase):
+    """Время сообщений для TTL-индекса"""
+
+    def test_naive_timestamp_is_local_time(self):
+        now = datetime.now()
+        parsed = server.parse_timestamp(now.isoformat())
+        self.assertIsNotNone(parsed.tzinfo)
+        self.assertEqual(parsed, now.astimezone())
+        self.assertLess(abs(parsed - datetime.now(timezone.utc)), timedelta(minutes=1))
+
+    def test_aware_timestamp_is_kept(self):
+        value = datetime(2024, 1, 1, 12, 0, tzinfo=timezone(timedelta(hours=3)))
+        self.assertEqual(server.parse_timestamp(value.isoformat()), value)
+
+    def test_local_offset_is_applied(self):
+        self.addCleanup(time.tzset)
+        with mock.patch.dict(os.environ, {'TZ': 'Europe/Moscow'}):
+            time.tzset()
+            parsed = server.parse_timestamp('2024-01-01T12:00:00')
+        self.assertEqual(parsed.astimezone(timezone.utc), datetime(2024, 1, 1, 9, 0, tzinfo=timezone.utc))
+
+
+class HistoryStorageTest(unittest.TestCase):
+    """Восстановление истории улучшений и свертка сообщений"""
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        for patch in [
+            mock.patch.object(server, 'db', self.db),
+            mock.patch.object(server, 'IMPROVEMENTS_KEYFRAME_INTERVAL', 3),
+            mock.patch.object(server, 'HISTORY_BATCH_SIZE', 2),
+        ]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.clock = 0
+
+    def timestamp(self):
+        self.clock += 1
+        return f"2024-01-01T00:00:{self.clock:02d}"
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def results(self, count):
+        return [{'run': i, 'stats': {'lines': 100 + i, 'files': {'server.py': i % 2}}, 'notes': ['x'] * (i % 3)} for i in range(count)]
+
+    def test_load_improvements_across_keyframes(self):
+        results = self.results(8)
+        analysis = {'functions': 5}
+        with mock.patch.object(server, 'datetime') as fake_datetime:
+            fake_datetime.now.return_value.isoformat.side_effect = self.timestamp
+            for result in results:
+                self.run_async(server.store_improvement(analysis, result))
+
+        stored = sorted(self.db.improvements.documents, key=lambda record: record['timestamp'])
+        self.assertEqual([record['depth'] for record in stored], [0, 1, 2, 0, 1, 2, 0, 1])
+        self.assertEqual(len(self.db.analysis_snapshots.documents), 1)
+
+        for limit in (1, 2, 3, 5, 8):
+            history = self.run_async(server.load_improvements(limit))
+            self.assertEqual([entry['result'] for entry in history], results[-limit:])
+            self.assertTrue(all(entry['analysis'] == analysis for entry in history))
+
+    def test_load_improvements_after_legacy_compaction(self):
+        results = self.results(7)
+        analyses = [{'functions': i // 2} for i in range(7)]
+        for result, analysis in zip(results, analyses):
+            self.db.improvements.documents.append({
+                '_id': ObjectId(), 'timestamp': self.timestamp(), 'result': result, 'analysis': analysis
+            })
+
+        self.assertEqual(self.run_async(server.compact_improvements()), 7)
+        stored = sorted(self.db.improvements.documents, key=lambda record: record['timestamp'])
+        self.assertFalse(any('analysis' in record for record in stored))
+        self.assertEqual([record['depth'] for record in stored], [0, 1, 2, 0, 1, 2, 0])
+        self.assertEqual(len(self.db.analysis_snapshots.documents), 4)
+
+        # Новая запись после сжатия строится от последней старой записи
+        with mock.patch.object(server, 'datetime') as fake_datetime:
+            fake_datetime.now.return_value.isoformat.side_effect = self.timestamp
+            self.run_async(server.store_improvement({'functions': 9}, {'run': 7}))
+
+        history = self.run_async(server.load_improvements(8))
+        self.assertEqual([entry['result'] for entry in history], results + [{'run': 7}])
+        self.assertEqual([entry['analysis'] for entry in history], analyses + [{'functions': 9}])
+        self.assertEqual(self.run_async(server.compact_improvements()), 0)
+
+    def test_rollup_is_idempotent_after_interrupted_delete(self):
+        for i in range(5):
+            self.db.messages.documents.append({
+                '_id': ObjectId(), 'timestamp': f"2024-01-0{1 + i % 2}T10:00:00",
+                'type': 'user' if i % 2 else 'ai', 'improvements': ['a'] * i
+            })
+
+        delete_many = FakeCollection.delete_many
+        calls = []
+
+        async def failing_delete(collection, query):
+            calls.append(query)
+            if len(calls) == 2:
+                raise RuntimeError("connection lost")
+            await delete_many(collection, query)
+
+        with mock.patch.object(server, 'MESSAGES_RETENTION_DAYS', 30), \
+                mock.patch.object(FakeCollection, 'delete_many', failing_delete):
+            with self.assertRaises(RuntimeError):
+                self.run_async(server.apply_message_retention())
+            self.run_async(server.apply_message_retention())
+            self.assertEqual(self.run_async(server.apply_message_retention()), {'messages_rolled_up': 0})
+
+        self.assertEqual(self.db.messages.documents, [])
+        rollups = {rollup['_id']: rollup for rollup in self.db.message_rollups.documents}
+        self.assertEqual(rollups['2024-01-01']['ai_messages'], 3)
+        self.assertEqual(rollups['2024-01-01']['improvements'], 0 + 2 + 4)
+        self.assertEqual(rollups['2024-01-02']['user_messages'], 2)
+        self.assertEqual(rollups['2024-01-02']['improvements'], 1 + 3)
+        self.assertEqual(sum(rollup.get('user_messages', 0) + rollup.get('ai_messages', 0) for rollup in rollups.values()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
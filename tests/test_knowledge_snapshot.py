@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from server import KnowledgeSnapshot, RelevanceIndex, build_knowledge_engine, build_knowledge_snapshot
+
+
+RECORDS = [
+    {'filename': 'asyncio.md', 'knowledge': ['Python asyncio: цикл событий', 'Функция: gather']},
+    {'filename': 'django.md', 'knowledge': ['Python django: модели и представления']},
+    {'filename': 'https://example.com/rust', 'knowledge': ['Rust tokio runtime'], 'source': 'web'},
+]
+
+
+class KnowledgeSnapshotTest(unittest.TestCase):
+    """Запись снимка на диск, чтение через mmap и замещение строк"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.path = os.path.join(self.directory, 'snapshot-test')
+
+    def write(self, records=RECORDS, meta=None):
+        self.assertTrue(build_knowledge_snapshot(self.path, records, meta or {'watermark': '2024-01-01'}))
+        return KnowledgeSnapshot(self.path)
+
+    def test_write_then_read(self):
+        snapshot = self.write()
+        self.assertEqual(snapshot.documents, 3)
+        self.assertEqual(snapshot.meta['version'], KnowledgeSnapshot.VERSION)
+        self.assertEqual(snapshot.meta['watermark'], '2024-01-01')
+        self.assertEqual(snapshot.doc_frequency('python'), 2)
+        self.assertEqual(snapshot.doc_frequency('missing'), 0)
+
+        row = snapshot.key_row('knowledge:https://example.com/rust')
+        self.assertGreaterEqual(row, 0)
+        self.assertEqual(snapshot.payload(row)['url'], 'https://example.com/rust')
+        self.assertEqual(snapshot.key_row('knowledge:missing.md'), -1)
+
+        results = snapshot.search({'tokio': 1.0}, 3)
+        self.assertEqual([result['title'] for result in results], ['Знания из https://example.com/rust'])
+
+    def test_key_rows_skip_replaced_documents(self):
+        # Повторная загрузка файла заменяет строку: в снимок попадает только новая версия
+        engine = build_knowledge_engine(RECORDS + [{'filename': 'asyncio.md', 'knowledge': ['Python trio nursery']}])
+        KnowledgeSnapshot.write(self.path, engine, {})
+        snapshot = KnowledgeSnapshot(self.path)
+        self.assertEqual(snapshot.documents, 3)
+        for key in ('knowledge:asyncio.md', 'knowledge:django.md', 'knowledge:https://example.com/rust'):
+            row = snapshot.key_row(key)
+            self.assertEqual(snapshot.payload(row)['title'], f"Знания из {key.split(':', 1)[1]}")
+        self.assertEqual(snapshot.search({'gather': 1.0}, 3), [])
+        self.assertEqual(len(snapshot.search({'trio': 1.0}, 3)), 1)
+
+    def test_old_version_is_rejected(self):
+        self.write()
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, version=2), f)
+        with self.assertRaises(ValueError):
+            KnowledgeSnapshot(self.path)
+
+    def test_index_shadows_snapshot_rows(self):
+        index = RelevanceIndex(self.write())
+        index.add_knowledge({'filename': 'asyncio.md', 'knowledge': ['Python trio nursery']})
+        self.assertEqual(index.search('gather'), [])
+        results = index.search('trio')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['snippet'], 'Python trio nursery')
+        self.assertEqual(len(index.search('python', 5)), 2)
+
+    def test_swap_keeps_snippets_and_replays_pending(self):
+        index = RelevanceIndex()
+        index.add_search_result({'title': 'Snake', 'snippet': 'python reptile', 'url': 'https://example.com/snake'})
+        index.start_reload()
+        index.add_knowledge({'filename': 'late.md', 'knowledge': ['Загружено во время перезагрузки']})
+        snapshot = self.write()
+        index.swap_knowledge(snapshot, build_knowledge_engine([], snapshot))
+        self.assertIsNone(index.pending)
+        self.assertEqual(index.knowledge.documents, 1)
+        self.assertEqual(index.snippets.documents, 1)
+        self.assertEqual(index.search('перезагрузки')[0]['title'], 'Знания из late.md')
+        self.assertEqual(index.search('reptile')[0]['title'], 'Snake')
+
+
+if __name__ == '__main__':
+    unittest.main()
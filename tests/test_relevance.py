@@ -0,0 +1,98 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+import server
+from server import RelevanceEngine, RelevanceIndex, count_tokens
+
+
+def knowledge_record(filename, knowledge, source=None):
+    record = {'filename': filename, 'knowledge': knowledge}
+    if source:
+        record['source'] = source
+    return record
+
+
+class RelevanceEngineTest(unittest.TestCase):
+    """Добавление, замена и удаление документов слоя"""
+
+    def setUp(self):
+        self.engine = RelevanceEngine()
+        self.engine.add_document('a', 'python asyncio event loop', {'title': 'A'})
+        self.engine.add_document('b', 'python django models', {'title': 'B'})
+
+    def search(self, text, top_k=5):
+        tokens = count_tokens(text)
+        return self.engine.search({token: 1.0 for token in tokens}, top_k)
+
+    def test_add_and_search(self):
+        self.assertEqual(self.engine.documents, 2)
+        self.assertEqual([result['title'] for result in self.search('asyncio')], ['A'])
+        self.assertEqual(self.engine.doc_frequency('python'), 2)
+
+    def test_replace_keeps_one_row_per_key(self):
+        self.engine.add_document('a', 'rust tokio runtime', {'title': 'A2'})
+        self.assertEqual(self.engine.documents, 2)
+        self.assertEqual(self.search('asyncio'), [])
+        self.assertEqual([result['title'] for result in self.search('tokio')], ['A2'])
+        self.assertEqual(self.engine.doc_frequency('python'), 1)
+        self.assertEqual(self.engine.doc_frequency('asyncio'), 0)
+        self.assertIsNone(self.engine.payloads[0])
+
+    def test_remove(self):
+        self.assertTrue(self.engine.remove_document('b'))
+        self.assertFalse(self.engine.remove_document('b'))
+        self.assertEqual(self.engine.documents, 1)
+        self.assertEqual(self.engine.doc_frequency('django'), 0)
+        self.assertEqual([result['title'] for result in self.search('python')], ['A'])
+
+    def test_weights_are_cached_until_change(self):
+        weights = self.engine.normalized_weights()
+        self.assertIs(self.engine.normalized_weights(), weights)
+        self.engine.add_document('c', 'python typing', {'title': 'C'})
+        self.assertIsNot(self.engine.normalized_weights(), weights)
+
+
+class RelevanceIndexTest(unittest.TestCase):
+    """Слияние оценок слоев знаний и сниппетов"""
+
+    def test_partial_match_in_small_layer_does_not_outrank_full_match(self):
+        index = RelevanceIndex()
+        index.add_knowledge(knowledge_record('asyncio.md', [
+            'Python asyncio: цикл событий и корутины',
+            'Функция: gather', 'Функция: create_task', 'Класс: Queue', 'Класс: Semaphore'
+        ]))
+        for i, topic in enumerate(['django', 'flask', 'numpy', 'pandas', 'pytest', 'typing']):
+            index.add_knowledge(knowledge_record(f"{topic}.md", [
+                f"Python {topic}: основные возможности", f"Функция: {topic}_main", f"Класс: {topic.title()}App"
+            ]))
+        index.add_search_result({'title': 'Snake', 'snippet': 'python reptile', 'url': 'https://example.com/snake'})
+
+        results = index.search('python asyncio', 5)
+        self.assertEqual(results[0]['title'], 'Знания из asyncio.md')
+        snake = [result for result in results if result['title'] == 'Snake']
+        self.assertTrue(not snake or snake[0]['score'] < results[0]['score'])
+
+    def test_query_norm_covers_terms_missing_from_layer(self):
+        index = RelevanceIndex()
+        index.add_search_result({'title': 'Snake', 'snippet': 'python', 'url': 'https://example.com/snake'})
+        weights = index.query_weights('python asyncio')
+        self.assertEqual(set(weights), {'python', 'asyncio'})
+        # Сниппет совпадает только с одним термином из двух и не может получить полную оценку
+        self.assertLess(index.search('python asyncio')[0]['score'], 0.99)
+
+    @mock.patch.object(server, 'RELEVANCE_SNIPPET_LIMIT', 10)
+    def test_snippet_generations_are_bounded(self):
+        index = RelevanceIndex()
+        for i in range(30):
+            index.add_search_result({'title': f"t{i}", 'snippet': 'python', 'url': f"https://example.com/{i}"})
+        self.assertFalse(index.add_search_result({'title': 't29', 'snippet': 'python', 'url': 'https://example.com/29'}))
+        self.assertLessEqual(index.snippets.documents + index.previous_snippets.documents, 10)
+        self.assertEqual(len(index.search('python', 30)), index.snippets.documents + index.previous_snippets.documents)
+
+
+if __name__ == '__main__':
+    unittest.main()